@@ -0,0 +1,642 @@
+import argparse
+import heapq
+import json
+import os
+import platform
+import random
+import select
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# rendering benchmarks draw on off-screen surfaces, no window is needed
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from common.world import World, generate_perlin_noise_2d
+from common.pathfinding import PathfindingService
+from common.world_format import encode_changes
+from common.utils import recvall, sendall
+from common.framing import FrameDecoder, get_available_codecs
+from common.player import Player
+from common import protocol
+from common import snapshot
+from common import datagram
+
+# Benchmarks of the hot paths, results are printed and written as JSON:
+#   python main.py --sizes 8 16 32 --clients 1 10 50 --output results.json
+
+
+def measure(function, repeat=5, number=1):
+    'runs function number times per repeat, returns times of one call in ms'
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number * 1000)
+    return {
+        'min_ms': min(times),
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.mean(times),
+        'repeat': repeat,
+        'number': number,
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def make_world(size):
+    world = World((size, size))
+    world.generate_world_from_perlin_noise()
+    return world
+
+
+def bench_noise(size, repeat):
+    shape = (size * 32, size * 32)
+    return measure(lambda: generate_perlin_noise_2d(shape, (size, size), seed=0), repeat)
+
+
+def bench_generation(size, repeat):
+    return measure(lambda: make_world(size), repeat)
+
+
+def bench_serialization(size, repeat):
+    world = make_world(size)
+    results = {}
+    for compress in (False, True):
+        data = world.to_binary(compress=compress)
+        name = 'compressed' if compress else 'raw'
+        results[f'to_binary_{name}'] = measure(lambda: world.to_binary(compress=compress), repeat)
+        results[f'from_binary_{name}'] = measure(lambda: World().from_binary(data), repeat)
+        results[f'{name}_bytes'] = len(data)
+    return results
+
+
+def bench_block_lookup(size, repeat, count=100000):
+    world = make_world(size)
+    limit = size * world.CHUNK_SIZE * 64
+    positions = np.random.default_rng(0).uniform(0, limit, (count, 2)).tolist()
+
+    def lookup():
+        for pos in positions:
+            world.get_block_by_pos(pos)
+
+    def speed_lookup():
+        for pos in positions:
+            world.get_speed_multiplier(pos)
+
+    array = np.array(positions)
+    results = {
+        'block': measure(lookup, repeat),
+        'speed': measure(speed_lookup, repeat),
+        'speed_batch': measure(lambda: world.get_speed_multipliers(array), repeat),
+        'lookups': count,
+    }
+    for name in ('block', 'speed', 'speed_batch'):
+        results[name]['ns_per_lookup'] = results[name]['median_ms'] * 1e6 / count
+    return results
+
+
+def bench_pathfinding(size, repeat, entities=5000):
+    'flow field of one goal, then steps of entities around it'
+    world = make_world(size)
+    center = size * world.CHUNK_SIZE * 64 / 2
+    goal = (center, center)
+    positions = np.random.default_rng(0).uniform(center - 4000, center + 4000, (entities, 2))
+
+    def make_field():
+        service = PathfindingService(world)
+        service.get_field(goal)
+
+    service = PathfindingService(world)
+    service.get_field(goal)
+    return {
+        'field': measure(make_field, repeat),
+        'velocities': measure(lambda: service.get_velocities(positions, goal, 5), repeat, number=10),
+        'entities': entities,
+    }
+
+
+def bench_edits(size, repeat, edits=(1, 10, 100)):
+    'bytes sent to a client for some changed blocks of a chunk: diff or the whole chunk'
+    world = make_world(size)
+    pos = (size // 2, size // 2)
+    rng = np.random.default_rng(0)
+    block_ids = [block_id for block_id in world.id_dict if world.is_valid_block(block_id, 0)]
+    results = {
+        'chunk_raw_bytes': len(world.to_binary([pos], compress=False)),
+        'chunk_compressed_bytes': len(world.to_binary([pos], compress=True)),
+    }
+    for count in edits:
+        version = world.chunks[pos].version
+        for block_x, block_y in rng.integers(0, world.CHUNK_SIZE, (count, 2)).tolist():
+            world.set_block(pos[0], pos[1], block_x, block_y, int(rng.choice(block_ids)))
+
+        def encode():
+            return encode_changes([(pos, world.chunks[pos].version, world.get_changes(pos, version))])
+
+        results[f'diff/{count}'] = measure(encode, repeat, number=100)
+        results[f'diff/{count}']['bytes'] = len(encode())
+    return results
+
+
+def bench_render(size, repeat, resolution=(1920, 1080)):
+    world = make_world(size)
+    canvas = pygame.Surface(resolution)
+    center = size * world.CHUNK_SIZE * 64 / 2
+    offset = (resolution[0] // 2 - center, resolution[1] // 2 - center)
+    visible_area = (-offset[0], -offset[1], -offset[0] + resolution[0], -offset[1] + resolution[1])
+
+    def render_cold():
+        world.chunk_surfaces = {}
+        world.render(canvas, offset, visible_area)
+
+    def walk(frames=1000, speed=5):
+        'frame times of walking right through the chunks, surfaces are made ahead of the screen'
+        world.chunk_surfaces = {}
+        world.chunk_surface_build = None
+        times = []
+        for frame in range(frames):
+            dx = frame * speed - frames * speed // 2
+            start = time.perf_counter()
+            world.render(
+                canvas,
+                (offset[0] - dx, offset[1]),
+                (visible_area[0] + dx, visible_area[1], visible_area[2] + dx, visible_area[3])
+            )
+            times.append((time.perf_counter() - start) * 1000)
+        # the first frames make the visible surfaces whole
+        times = sorted(times[10:])
+        return {'max_ms': times[-1], 'p99_ms': times[int(len(times) * 0.99)], 'median_ms': statistics.median(times)}
+
+    return {
+        'cold': measure(render_cold, repeat),
+        'warm': measure(lambda: world.render(canvas, offset, visible_area), repeat, number=10),
+        'walk': walk(),
+        'blocks': measure(lambda: world.render_blocks(canvas, offset, visible_area), repeat),
+        'resolution': resolution,
+    }
+
+
+def bench_socketpair(payload_size, messages):
+    'sendall / recvall throughput of one direction of a local socketpair'
+    world = make_world(max(1, int((payload_size / 2048) ** 0.5)))
+    # world data, so that compression sees realistic input
+    payload = (world.to_binary(compress=False) * (payload_size // 2048 + 1))[:payload_size]
+    a, b = socket.socketpair()
+
+    def sender():
+        for _ in range(messages):
+            sendall(a, payload)
+
+    thread = threading.Thread(target=sender)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(messages):
+        recvall(b)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    a.close()
+    b.close()
+
+    return {
+        'payload_bytes': payload_size,
+        'messages': messages,
+        'seconds': elapsed,
+        'messages_per_s': messages / elapsed,
+        'mb_per_s': payload_size * messages / elapsed / 2**20,
+    }
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, world_path, world_size, server_args):
+    server = subprocess.Popen(
+        [
+            sys.executable, 'main.py', '--port', str(port), '--world', world_path,
+            '--size', str(world_size), '--seed', '0', *server_args
+        ],
+        cwd=os.path.join(ROOT, 'server'),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+
+def run_bot(port, index, duration, results, spread=100):
+    'a client that walks around, requests chunks and waits for snapshots'
+    s = socket.create_connection(('localhost', port))
+    kind, (chunk_size, chunks_count) = protocol.unpack(recvall(s))
+    player = Player([1000. + index * spread, 1000.], f'bot{index}')
+    sendall(s, protocol.pack(protocol.PLAYER, (player, get_available_codecs())))
+    protocol.unpack(recvall(s))
+
+    latencies = []
+    received = 0
+    chunks = 0
+    acked_seq = 0
+    input_seq = 0
+    sendall(s, protocol.pack(protocol.CHUNKS_REQUEST, [(0, 0), (0, 1), (1, 0), (1, 1)]))
+
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        player.pos[0] += 10
+        input_seq += 1
+        sent = time.perf_counter()
+        sendall(s, protocol.pack(
+            protocol.POSITION, snapshot.POSITION_RECORD.pack(acked_seq, input_seq, *player.pos)
+        ))
+
+        # time to the next snapshot, that has the new position applied
+        while True:
+            data = recvall(s)
+            received += len(data)
+            kind, payload = protocol.unpack(data)
+            if kind == protocol.CHUNKS:
+                chunks += 1
+                continue
+            if kind == protocol.SNAPSHOT:
+                acked_seq = snapshot.decode_delta(payload)[0]
+                break
+        latencies.append(time.perf_counter() - sent)
+
+    s.close()
+    results.append((latencies, received, chunks))
+
+
+def bench_load(clients, duration, world_size, server_args, spread=100):
+    port = get_free_port()
+    results = []
+    # removed after the server saved and exited
+    with tempfile.TemporaryDirectory(prefix='benchmark_world_') as world_path:
+        server = start_server(port, world_path, world_size, server_args)
+        try:
+            bots = [
+                threading.Thread(target=run_bot, args=(port, i, duration, results, spread))
+                for i in range(clients)
+            ]
+            for bot in bots:
+                bot.start()
+            for bot in bots:
+                bot.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = [latency * 1000 for bot_latencies, _, _ in results for latency in bot_latencies]
+    return {
+        'clients': clients,
+        'spread': spread,
+        'connected': len(results),
+        'duration_s': duration,
+        'server_args': server_args,
+        'updates': len(latencies),
+        'updates_per_s': len(latencies) / duration,
+        'latency_p50_ms': percentile(latencies, 0.5) if latencies else None,
+        'latency_p99_ms': percentile(latencies, 0.99) if latencies else None,
+        'received_bytes': sum(received for _, received, _ in results),
+        'chunk_messages': sum(chunks for _, _, chunks in results),
+    }
+
+
+class LossyProxy():
+    '''
+    Forwards one client to the server over localhost with injected packet
+    loss, in process because netem is not available everywhere. A lost
+    datagram is dropped. A lost tcp read is delivered after a retransmission
+    timeout and holds back everything after it, like a lost segment does.
+    '''
+
+    def __init__(self, server_port, loss, latency=0.01, rto=0.2, seed=0) -> None:
+        self.server_port = server_port
+        self.loss = loss
+        # one way
+        self.latency = latency
+        # the minimum retransmission timeout of linux
+        self.rto = rto
+        self.random = random.Random(seed)
+
+        self.tcp_listener = socket.create_server(('localhost', 0))
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind(('localhost', 0))
+        self.udp_upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_upstream.connect(('localhost', server_port))
+        self.tcp_port = self.tcp_listener.getsockname()[1]
+        self.udp_port = self.udp_socket.getsockname()[1]
+        self.client_udp_addres = None
+
+        # (release time, order, function, args)
+        self.scheduled = []
+        self.order = 0
+        self.condition = threading.Condition()
+        self.is_running = False
+
+    def is_lost(self):
+        return self.random.random() < self.loss
+
+    def schedule(self, release, function, *args):
+        with self.condition:
+            heapq.heappush(self.scheduled, (release, self.order, function, args))
+            self.order += 1
+            self.condition.notify()
+
+    def deliver(self):
+        while self.is_running:
+            with self.condition:
+                while self.is_running and (
+                    not self.scheduled or self.scheduled[0][0] > time.perf_counter()
+                ):
+                    timeout = self.scheduled[0][0] - time.perf_counter() if self.scheduled else None
+                    self.condition.wait(timeout)
+                if not self.is_running:
+                    return
+                _, _, function, args = heapq.heappop(self.scheduled)
+            try:
+                function(*args)
+            except OSError:
+                pass
+
+    def pump_tcp(self, source, target):
+        release = 0
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self.schedule(time.perf_counter() + self.latency, target.close)
+                return
+            delay = self.latency + (self.rto if self.is_lost() else 0)
+            # in order, a late read delays everything behind it
+            release = max(release, time.perf_counter() + delay)
+            self.schedule(release, target.sendall, data)
+
+    def accept_tcp(self):
+        while self.is_running:
+            try:
+                client, _ = self.tcp_listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(('localhost', self.server_port))
+            for source, target in ((client, upstream), (upstream, client)):
+                threading.Thread(target=self.pump_tcp, args=(source, target), daemon=True).start()
+
+    def pump_udp(self):
+        while self.is_running:
+            r_sockets, *_ = select.select([self.udp_socket, self.udp_upstream], [], [], 0.1)
+            for r_socket in r_sockets:
+                try:
+                    data, addres = r_socket.recvfrom(65536)
+                except OSError:
+                    continue
+                if r_socket is self.udp_socket:
+                    self.client_udp_addres = addres
+                    target = (self.udp_upstream.send, data)
+                else:
+                    target = (self.udp_socket.sendto, data, self.client_udp_addres)
+                if not self.is_lost():
+                    self.schedule(time.perf_counter() + self.latency, *target)
+
+    def start(self):
+        self.is_running = True
+        for target in (self.deliver, self.accept_tcp, self.pump_udp):
+            threading.Thread(target=target, daemon=True).start()
+
+    def stop(self):
+        self.is_running = False
+        with self.condition:
+            self.condition.notify()
+        self.tcp_listener.close()
+
+
+def run_loss_bot(proxy, index, duration, use_udp, results, send_rate=20):
+    '''
+    Sends positions at send_rate and measures the update latency: time from
+    sending a position to the first snapshot that includes it or a newer one
+    '''
+    s = socket.create_connection(('localhost', proxy.tcp_port))
+    protocol.unpack(recvall(s))
+    player = Player([1000. + index * 100, 1000.], f'bot{index}')
+    sendall(s, protocol.pack(protocol.PLAYER, (player, get_available_codecs())))
+    protocol.unpack(recvall(s))
+
+    udp_socket = None
+    if use_udp:
+        kind, (token, _) = protocol.unpack(recvall(s))
+        # datagrams go through the proxy, not to the port of the session
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.connect(('localhost', proxy.udp_port))
+    sockets = [s] if udp_socket is None else [s, udp_socket]
+
+    decoder = FrameDecoder()
+    # input seq -> send time
+    sent = {}
+    latencies = []
+    acked_seq = 0
+    input_seq = 0
+    next_send = time.perf_counter()
+    deadline = next_send + duration
+    while time.perf_counter() < deadline:
+        if time.perf_counter() >= next_send:
+            player.pos[0] += 10
+            input_seq += 1
+            record = snapshot.POSITION_RECORD.pack(acked_seq, input_seq, *player.pos)
+            if udp_socket is not None:
+                udp_socket.send(datagram.pack(datagram.POSITION, token, record))
+            else:
+                sendall(s, protocol.pack(protocol.POSITION, record))
+            sent[input_seq] = time.perf_counter()
+            next_send += 1 / send_rate
+
+        r_sockets, *_ = select.select(sockets, [], [], max(0, next_send - time.perf_counter()))
+        deltas = []
+        if udp_socket is not None and udp_socket in r_sockets:
+            try:
+                deltas.append(datagram.unpack(udp_socket.recv(65536))[2])
+            except OSError:
+                pass
+        if s in r_sockets:
+            if decoder.recv_into(s) == 0:
+                break
+            for data in decoder.frames():
+                kind, payload = protocol.unpack(data)
+                if kind == protocol.SNAPSHOT:
+                    deltas.append(payload)
+
+        for delta in deltas:
+            arrival = time.perf_counter()
+            seq, *_, echoed_seq = snapshot.decode_delta(delta)
+            acked_seq = max(acked_seq, seq)
+            for seq in [seq for seq in sent if seq <= echoed_seq]:
+                latencies.append(arrival - sent.pop(seq))
+
+    s.close()
+    if udp_socket is not None:
+        udp_socket.close()
+    results.append(latencies)
+
+
+def bench_loss(loss, duration, world_size, server_args, clients=4):
+    'update latency with positions and snapshots over tcp and over udp'
+    port = get_free_port()
+    result = {'loss': loss, 'clients': clients, 'duration_s': duration}
+    with tempfile.TemporaryDirectory(prefix='benchmark_world_') as world_path:
+        server = start_server(port, world_path, world_size, ['--udp', *server_args])
+        try:
+            for transport in ('tcp', 'udp'):
+                results = []
+                proxies = [LossyProxy(port, loss, seed=i) for i in range(clients)]
+                bots = [
+                    threading.Thread(
+                        target=run_loss_bot, args=(proxy, i, duration, transport == 'udp', results)
+                    )
+                    for i, proxy in enumerate(proxies)
+                ]
+                for proxy in proxies:
+                    proxy.start()
+                for bot in bots:
+                    bot.start()
+                for bot in bots:
+                    bot.join()
+                for proxy in proxies:
+                    proxy.stop()
+
+                latencies = [latency * 1000 for bot_latencies in results for latency in bot_latencies]
+                result[transport] = {
+                    'updates': len(latencies),
+                    'latency_p50_ms': percentile(latencies, 0.5) if latencies else None,
+                    'latency_p99_ms': percentile(latencies, 0.99) if latencies else None,
+                    'latency_p999_ms': percentile(latencies, 0.999) if latencies else None,
+                    'latency_max_ms': max(latencies) if latencies else None,
+                }
+        finally:
+            server.terminate()
+            server.wait()
+    return result
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pygame': pygame.version.ver,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks of the world, rendering and networking')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 16, 32], help='world sizes in chunks')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50], help='clients of the load tests')
+    parser.add_argument('--payloads', type=int, nargs='+', default=[1024, 65536, 1048576], help='socketpair message sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=5, help='seconds of every load test')
+    parser.add_argument(
+        '--loss', type=float, nargs='+', default=[0, 0.01, 0.05],
+        help='packet loss rates of the tcp / udp comparison'
+    )
+    parser.add_argument(
+        '--only', nargs='+',
+        choices=(
+            'noise', 'generation', 'serialization', 'lookup', 'pathfinding', 'edits', 'render',
+            'socketpair', 'load', 'loss'
+        ),
+        help='run only these benchmarks'
+    )
+    parser.add_argument('--server-args', default='', help='extra arguments of the load test server')
+    parser.add_argument(
+        '--spread', type=float, default=100,
+        help='pixels between the players of the load test bots, 32768 puts every bot in its own '
+        'region of a sharded server (--server-args "--shards 4 --size 0")'
+    )
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    def enabled(name):
+        return args.only is None or name in args.only
+
+    pygame.init()
+    results = {'environment': get_environment(), 'benchmarks': {}}
+    benchmarks = results['benchmarks']
+
+    def record(name, result):
+        benchmarks[name] = result
+        print(name, json.dumps(result))
+
+    for size in args.sizes:
+        if enabled('noise'):
+            record(f'noise/{size}', bench_noise(size, args.repeat))
+        if enabled('generation'):
+            record(f'generation/{size}', bench_generation(size, args.repeat))
+        if enabled('serialization'):
+            record(f'serialization/{size}', bench_serialization(size, args.repeat))
+        if enabled('lookup'):
+            record(f'lookup/{size}', bench_block_lookup(size, args.repeat))
+        if enabled('pathfinding'):
+            record(f'pathfinding/{size}', bench_pathfinding(size, args.repeat))
+        if enabled('edits'):
+            record(f'edits/{size}', bench_edits(size, args.repeat))
+        if enabled('render'):
+            record(f'render/{size}', bench_render(size, args.repeat))
+
+    if enabled('socketpair'):
+        for payload_size in args.payloads:
+            messages = max(10, min(10000, 2**26 // payload_size))
+            record(f'socketpair/{payload_size}', bench_socketpair(payload_size, messages))
+
+    if enabled('load'):
+        for clients in args.clients:
+            record(
+                f'load/{clients}',
+                bench_load(clients, args.duration, max(args.sizes), args.server_args.split(), args.spread)
+            )
+
+    if enabled('loss'):
+        for loss in args.loss:
+            record(
+                f'loss/{loss}',
+                bench_loss(loss, args.duration, max(args.sizes), args.server_args.split())
+            )
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
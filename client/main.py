@@ -1,49 +1,69 @@
 from sys import flags
 import pygame
 import socket
-import cloudpickle as pickle
 from pygame import key
 from settings import get_settings
+from profiler import FrameProfiler
+from presentation import Presenter
 import sys
 import threading
 import math
-from select import select
+import time
+import logging
 
 sys.path.append('../')
 
 from common.world import World
 from common.utils import recvall, sendall
+from common.framing import get_available_codecs
 from common.player import Player
+from common import protocol
+
+# after sys.path is set, it uses common
+from network import Network
 
 settings = get_settings()
 
+logging.basicConfig(level=settings.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('client')
+
 main_socket = socket.socket(
     socket.AF_INET,
     socket.SOCK_STREAM,
 )
 
-print((settings.server_addres, settings.server_port))
+logger.info('connecting to %s:%s', settings.server_addres, settings.server_port)
 main_socket.connect((settings.server_addres, settings.server_port))
-response = recvall(main_socket)
+kind, (chunk_size, chunks_count) = protocol.unpack(recvall(main_socket))
 
-world = World()
-world.from_binary(response)
+world = World(chunks_count, max_loaded_chunks=settings.max_loaded_chunks)
 
-world_max_x = world.chunks_count[0] * world.CHUNK_SIZE * 64
-world_max_y = world.chunks_count[1] * world.CHUNK_SIZE * 64
+if world.is_infinite():
+    # centre of chunk (0, 0)
+    spawn_x = spawn_y = world.CHUNK_SIZE * 64 / 2
+else:
+    spawn_x = world.chunks_count[0] * world.CHUNK_SIZE * 64 / 2
+    spawn_y = world.chunks_count[1] * world.CHUNK_SIZE * 64 / 2
 
-main_player = Player([world_max_x / 2, world_max_y / 2], settings.name)
-sendall(main_socket, pickle.dumps(main_player))
+main_player = Player([spawn_x, spawn_y], settings.name)
+sendall(main_socket, protocol.pack(protocol.PLAYER, (main_player, get_available_codecs())))
+kind, main_player_id = protocol.unpack(recvall(main_socket))
 
 other_players = []
 
 pygame.init()
 
 video_info = pygame.display.Info()
-print(video_info.current_w, video_info.current_h)
+logger.info('display %sx%s', video_info.current_w, video_info.current_h)
 
 screen = pygame.display.set_mode(size=(settings.resolution_x, settings.resolution_y), flags=pygame.FULLSCREEN)
-canvas = pygame.Surface(size=(1920, 1080))
+# 0 renders at the screen resolution
+internal_resolution = (settings.internal_resolution_x, settings.internal_resolution_y)
+presenter = Presenter(
+    screen,
+    internal_resolution if all(internal_resolution) else None,
+    settings.scale_mode
+)
 
 class Camera:
     def __init__(self, function=None) -> None:
@@ -72,15 +92,12 @@ target_delay = 1000 // settings.target_fps
 other_players = []
 lock = threading.Lock()
 
-def tcp():
-    global other_players, main_player, is_running
-    while is_running:
-        sendall(main_socket, pickle.dumps(main_player))
-        _ = select([main_socket], [], [])
-        other_players = pickle.loads(recvall(main_socket))
+# F3 toggles the overlay, the report is written on exit when it was enabled
+profiler = FrameProfiler(enabled=settings.show_profiler)
+profiler_font = pygame.font.Font(None, 24)
 
-tcp_thread = threading.Thread(target=tcp)
-tcp_thread.start()
+network = Network(main_socket, world, lock, main_player, main_player_id, settings)
+network.start()
 
 walk_dirs = {
     pygame.K_LEFT: [-1, 0],
@@ -89,11 +106,16 @@ walk_dirs = {
     pygame.K_DOWN: [0, 1]
 }
 
-while is_running:
+while is_running and network.is_running:
+    profiler.start_frame()
+
     events = pygame.event.get()
     for event in events:
         if event.type == pygame.QUIT:
             is_running = False
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            profiler.enabled = not profiler.enabled
+        presenter.on_event(event)
 
     lock.acquire()
     keys = pygame.key.get_pressed()
@@ -104,19 +126,22 @@ while is_running:
             walk_dir[0] += value[0]
             walk_dir[1] += value[1]
     norm = math.sqrt(walk_dir[0] ** 2 + walk_dir[1] ** 2)
-    if norm != 0:
+    speed_multiplier = world.get_speed_multiplier(main_player.pos)
+    # chunk under the player is not loaded yet
+    if norm != 0 and speed_multiplier is not None:
         walk_dir[0] /= norm
         walk_dir[1] /= norm
-        main_player.pos[0] += walk_dir[0] * 5 * world.get_block_by_pos((main_player.pos)).get_speed_multiplier()
-        main_player.pos[1] += walk_dir[1] * 5 * world.get_block_by_pos((main_player.pos)).get_speed_multiplier()
+        main_player.pos[0] += walk_dir[0] * 5 * speed_multiplier
+        main_player.pos[1] += walk_dir[1] * 5 * speed_multiplier
 
     if keys[pygame.K_ESCAPE]:
         is_running = False
     lock.release()
+    profiler.mark('input')
 
+    canvas = presenter.canvas
     dx, dy = camera.get_offset(main_player.pos, canvas.get_size())
 
-    screen.fill((0, 0, 0))
     canvas.fill((0, 0, 0))
 
     visible_area = (
@@ -126,7 +151,12 @@ while is_running:
         main_player.pos[1] + canvas.get_size()[1] // 2
     )
 
-    world.render(canvas, (dx, dy), visible_area)
+    with lock:
+        world.render(canvas, (dx, dy), visible_area)
+    profiler.mark('world')
+
+    # drawn a little in the past, between the two snapshots around that time
+    other_players = network.get_other_players()
 
     pygame.draw.rect(canvas, (0, 0, 255), (main_player.pos[0] + dx - 30, main_player.pos[1] + dy - 35, 60, 70))
     main_player_name = names_font.render(main_player.name, True, (255, 255, 255))
@@ -136,29 +166,29 @@ while is_running:
         pygame.draw.rect(canvas, (0, 255, 0), (other_player.pos[0] + dx - 30, other_player.pos[1] + dy - 35, 60, 70))
         other_player_name = names_font.render(other_player.name, True, (255, 255, 255))
         canvas.blit(other_player_name, (other_player.pos[0] - 10 + dx, other_player.pos[1] - 10 + dy))
+    profiler.mark('players')
 
-    screen_ratio = screen.get_size()[0] / screen.get_size()[1]
-
-    if screen_ratio <= 16 / 9:
-        scale = (int(screen.get_size()[1] * 16 / 9), screen.get_size()[1])
-    else:
-        scale = (screen.get_size()[0], int(screen.get_size()[0] * 9 / 16))
-    
-    print(scale)
-
-    scaled_canvas = pygame.transform.smoothscale(canvas, scale)
-    canvas_x_offset = (scaled_canvas.get_size()[0] - screen.get_size()[0]) // 2
-    screen.blit(scaled_canvas, (-canvas_x_offset, 0))
+    presenter.present()
+    profiler.mark('scale')
 
     if settings.show_debug:
         screen.blit(debug_font.render(f'{main_player.pos=}', True, (255, 255, 255)), (0, 0))
         screen.blit(debug_font.render(f'{world.get_block_by_pos((main_player.pos))=}', True, (255, 255, 255)), (0, 32))
 
+    profiler.render(screen, profiler_font, (0, 64 if settings.show_debug else 0))
+
     pygame.display.flip()
+    profiler.mark('flip')
 
     curr_time = pygame.time.get_ticks()
     pygame.time.delay(target_delay - (curr_time - last_update_time))
-    print(target_delay - (curr_time - last_update_time))
     last_update_time = pygame.time.get_ticks()
+    profiler.mark('wait')
+
+network.stop()
+
+if profiler.totals:
+    profiler.dump(settings.profiler_output)
+    logger.info('frame profile written to %s', settings.profiler_output)
 
 pygame.quit()
\ No newline at end of file
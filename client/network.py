@@ -0,0 +1,357 @@
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from select import select
+
+from common.utils import sendall
+from common.framing import FrameDecoder, FrameError
+from common.player import Player
+from common.world_format import decode_changes
+from common import protocol
+from common import snapshot
+from common import datagram
+
+logger = logging.getLogger('client.network')
+
+
+class SnapshotBuffer():
+    '''
+    Jitter buffer of received player states. Snapshots are placed on a
+    smoothed server timeline, time(seq) = base_time + (seq - base_seq) * tick_period,
+    and players are shown delay seconds in the past, interpolated between
+    the two snapshots around that time.
+    '''
+
+    def __init__(self, delay=0.1, size=32, tick_period=0.05) -> None:
+        self.delay = delay
+        self.size = size
+        # (seq, state), oldest first
+        self.snapshots = deque()
+        self.lock = threading.Lock()
+
+        self.base_seq = None
+        self.base_time = 0.
+        self.tick_period = tick_period
+        # (seq, arrival time) of the buffered snapshots
+        self.arrivals = deque(maxlen=size)
+
+    def get_time(self, seq):
+        return self.base_time + (seq - self.base_seq) * self.tick_period
+
+    def get_delay(self):
+        # at least two ticks, so that lower server tick rates still interpolate
+        return max(self.delay, 2 * self.tick_period)
+
+    def update_timeline(self, seq, arrival):
+        self.arrivals.append((seq, arrival))
+        if self.base_seq is None:
+            self.base_seq, self.base_time = seq, arrival
+            return
+
+        # tick period over the whole buffer, jitter of single arrivals averages out
+        first_seq, first_arrival = self.arrivals[0]
+        if seq > first_seq:
+            self.tick_period = (arrival - first_arrival) / (seq - first_seq)
+
+        # the timeline is anchored at the newest snapshot and moved gradually,
+        # so that interpolated players do not jump: fast towards early
+        # arrivals, slowly towards late ones, they are mostly jitter
+        self.base_time = self.get_time(seq)
+        self.base_seq = seq
+        error = arrival - self.base_time
+        self.base_time += (0.1 if error < 0 else 0.01) * error
+
+    def add(self, seq, state, arrival=None):
+        if arrival is None:
+            arrival = time.perf_counter()
+        with self.lock:
+            self.update_timeline(seq, arrival)
+            self.snapshots.append((seq, state))
+            while len(self.snapshots) > self.size:
+                self.snapshots.popleft()
+
+    def get_state(self, now=None):
+        'interpolated {player_id: (x, y)}'
+        if now is None:
+            now = time.perf_counter()
+
+        with self.lock:
+            if not self.snapshots:
+                return {}
+            render_time = now - self.get_delay()
+
+            older = None
+            newer = None
+            for seq, state in self.snapshots:
+                snapshot_time = self.get_time(seq)
+                if snapshot_time <= render_time:
+                    older = (snapshot_time, state)
+                else:
+                    newer = (snapshot_time, state)
+                    break
+
+        if older is None:
+            return dict(newer[1])
+        if newer is None:
+            # nothing newer arrived yet, players stay where they were last seen
+            return dict(older[1])
+
+        older_time, older_state = older
+        newer_time, newer_state = newer
+        t = (render_time - older_time) / (newer_time - older_time)
+        interpolated = {}
+        for player_id, pos in older_state.items():
+            next_pos = newer_state.get(player_id, pos)
+            interpolated[player_id] = (
+                pos[0] + (next_pos[0] - pos[0]) * t,
+                pos[1] + (next_pos[1] - pos[1]) * t
+            )
+        return interpolated
+
+
+class Network():
+    '''
+    Server connection running in its own thread: sends the position of the
+    main player at send_rate, requests missing chunks and buffers snapshots.
+    The main player is predicted locally and corrected when the server
+    position differs from the one that was sent. When the server opens a
+    udp session positions and snapshots go over udp, a lost datagram does
+    not hold back the ones after it like on tcp. Positions are sent over
+    tcp as well until a snapshot came over udp, and only over tcp again
+    once the server stops echoing them or sends snapshots over tcp.
+    '''
+
+    def __init__(self, socket, world, world_lock, main_player, main_player_id, settings) -> None:
+        self.socket = socket
+        self.world = world
+        # guards world and main_player, shared with the render loop
+        self.world_lock = world_lock
+        self.main_player = main_player
+        self.main_player_id = main_player_id
+        self.settings = settings
+
+        self.decoder = FrameDecoder()
+        # set when the server sent SESSION and use_udp is on
+        self.udp_socket = None
+        self.token = None
+        # positions go over udp only, set by the first snapshot over udp
+        self.udp_positions = False
+        # positions did not get through over udp, they stay on tcp
+        self.udp_failed = False
+        # positions over udp are given up when none is echoed for this long
+        self.udp_timeout = 1.
+        # or when this many snapshots in a row come over tcp
+        self.max_tcp_snapshots = 10
+        self.tcp_snapshots = 0
+        self.echoed_input_seq = 0
+        self.last_echo_time = 0.
+        # delta bases, states in the order they were received
+        self.snapshots = snapshot.SnapshotHistory()
+        self.buffer = SnapshotBuffer(settings.interpolation_delay)
+        self.player_names = {}
+        # chunk position -> time it was requested
+        self.requested_chunks = {}
+
+        self.input_seq = 0
+        # input seq -> position sent with it, until a snapshot includes it
+        self.sent_positions = OrderedDict()
+        # smaller differences from the server are float32 rounding
+        self.correction_threshold = 0.01
+
+        self.is_running = False
+        self.thread = None
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.udp_socket is not None:
+            self.udp_socket.close()
+
+    def open_session(self, token, port):
+        self.token = token
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.connect((self.socket.getpeername()[0], port))
+        self.udp_socket.setblocking(False)
+        # positions carry the token too, the hello only makes snapshots start sooner
+        self.send_datagram(datagram.HELLO)
+        logger.info('udp session opened on port %d', port)
+
+    def send_datagram(self, kind, payload=b''):
+        try:
+            self.udp_socket.send(datagram.pack(kind, self.token, payload))
+        except OSError as e:
+            # the server falls back to tcp for snapshots, positions are sent again
+            logger.debug('datagram not sent: %s', e)
+
+    def request_chunks(self):
+        player_chunk = self.world.get_chunk_pos(self.main_player.pos)
+        with self.world_lock:
+            self.world.unload_far_chunks(player_chunk, self.settings.view_distance + 1)
+            # requests the server did not answer are repeated after a second
+            missing_chunks = [
+                pos for pos in self.world.get_chunks_around(player_chunk, self.settings.view_distance)
+                if pos not in self.world.chunks and time.time() - self.requested_chunks.get(pos, 0) > 1
+            ]
+
+        if missing_chunks:
+            for pos in missing_chunks:
+                self.requested_chunks[pos] = time.time()
+            sendall(self.socket, protocol.pack(protocol.CHUNKS_REQUEST, missing_chunks))
+
+    def send_position(self):
+        self.input_seq += 1
+        with self.world_lock:
+            pos = snapshot.quantize(self.main_player.pos)
+        self.sent_positions[self.input_seq] = pos
+        position = snapshot.POSITION_RECORD.pack(self.snapshots.last_seq, self.input_seq, *pos)
+        if self.udp_positions and time.perf_counter() - self.last_echo_time > self.udp_timeout:
+            self.give_up_udp_positions('the server does not echo them')
+
+        # the server drops positions with an input seq it has seen already
+        if self.udp_socket is not None and not self.udp_failed:
+            self.send_datagram(datagram.POSITION, position)
+        if not self.udp_positions:
+            sendall(self.socket, protocol.pack(protocol.POSITION, position))
+
+    def give_up_udp_positions(self, reason):
+        logger.warning('positions are sent over tcp again, %s', reason)
+        self.udp_positions = False
+        self.udp_failed = True
+
+    def run(self):
+        send_delay = 1 / self.settings.send_rate
+        try:
+            while self.is_running:
+                self.request_chunks()
+                self.send_position()
+
+                # the server sends players every tick, independent of our updates
+                next_send = time.time() + send_delay
+                while self.is_running and time.time() < next_send:
+                    sockets = [self.socket] if self.udp_socket is None else [self.socket, self.udp_socket]
+                    r_sockets, *_ = select(sockets, [], [], max(0, next_send - time.time()))
+                    if self.udp_socket is not None and self.udp_socket in r_sockets:
+                        self.read_datagrams()
+                    if self.socket not in r_sockets:
+                        continue
+
+                    if self.decoder.recv_into(self.socket) == 0:
+                        logger.warning('server closed the connection')
+                        self.is_running = False
+                        break
+
+                    for data in self.decoder.frames():
+                        self.handle_message(data)
+        except OSError as e:
+            logger.warning('connection lost: %s', e)
+            self.is_running = False
+        except FrameError as e:
+            # the stream can not be followed after a frame that was not decoded
+            logger.error('frame not decoded, disconnecting: %s', e)
+            self.is_running = False
+
+    def read_datagrams(self):
+        while True:
+            try:
+                data = self.udp_socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # icmp errors, snapshots keep coming over tcp if udp is blocked
+                logger.debug('datagram not received: %s', e)
+                return
+
+            try:
+                kind, token, payload = datagram.unpack(data)
+            except datagram.DatagramError:
+                continue
+            if token == self.token and kind == datagram.SNAPSHOT:
+                self.on_snapshot(payload, over_udp=True)
+
+    def handle_message(self, data):
+        kind, payload = protocol.unpack(data)
+        if kind == protocol.CHUNKS:
+            with self.world_lock:
+                for pos in self.world.load_chunks_from_binary(payload):
+                    self.requested_chunks.pop(pos, None)
+        elif kind == protocol.BLOCKS:
+            with self.world_lock:
+                for pos, version, changes in decode_changes(payload):
+                    # changes of chunks unloaded since are in the chunk when it is requested again
+                    if pos in self.world.chunks:
+                        self.world.write_blocks(pos, changes)
+        elif kind == protocol.SNAPSHOT:
+            self.on_snapshot(payload)
+        elif kind == protocol.SESSION:
+            if self.settings.use_udp:
+                self.open_session(*payload)
+
+    def on_snapshot(self, data, over_udp=False):
+        seq, base_seq, updated, removed, names, input_seq = snapshot.decode_delta(data)
+        self.update_transport(input_seq, over_udp)
+        base = self.snapshots.get(base_seq)
+        # the base is too old, wait for a full snapshot
+        if base is None or seq <= self.snapshots.last_seq:
+            return
+
+        state = snapshot.apply_delta(base, updated, removed)
+        self.snapshots.add(seq, state)
+        self.buffer.add(seq, state)
+        for player_id in removed:
+            self.player_names.pop(player_id, None)
+        self.player_names.update(names)
+
+        self.reconcile(state.get(self.main_player_id), input_seq)
+
+    def update_transport(self, input_seq, over_udp):
+        now = time.perf_counter()
+        if input_seq > self.echoed_input_seq:
+            self.echoed_input_seq = input_seq
+            self.last_echo_time = now
+
+        if over_udp:
+            self.tcp_snapshots = 0
+            if not self.udp_positions and not self.udp_failed:
+                logger.info('snapshots come over udp, positions are sent over udp only')
+                self.udp_positions = True
+                self.last_echo_time = now
+        elif self.udp_positions:
+            self.tcp_snapshots += 1
+            if self.tcp_snapshots > self.max_tcp_snapshots:
+                self.give_up_udp_positions('the server sends snapshots over tcp')
+
+    def reconcile(self, server_pos, input_seq):
+        'moves the main player by how far the server is from the position sent with input_seq'
+        sent_pos = self.sent_positions.get(input_seq)
+        while self.sent_positions and next(iter(self.sent_positions)) <= input_seq:
+            self.sent_positions.popitem(last=False)
+        if server_pos is None or sent_pos is None:
+            return
+
+        error_x = server_pos[0] - sent_pos[0]
+        error_y = server_pos[1] - sent_pos[1]
+        if abs(error_x) <= self.correction_threshold and abs(error_y) <= self.correction_threshold:
+            return
+
+        logger.info('position corrected by (%.1f, %.1f)', error_x, error_y)
+        with self.world_lock:
+            # movement made since input_seq is kept on top of the server position
+            self.main_player.pos[0] += error_x
+            self.main_player.pos[1] += error_y
+        # positions sent after input_seq did not include the correction yet
+        self.sent_positions.clear()
+
+    def get_other_players(self, now=None):
+        return [
+            Player(list(pos), self.player_names.get(player_id, ''))
+            for player_id, pos in self.buffer.get_state(now).items()
+            if player_id != self.main_player_id
+        ]
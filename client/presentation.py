@@ -0,0 +1,78 @@
+import pygame
+
+SCALE_MODES = ('smooth', 'fast', 'integer')
+
+
+class Presenter():
+    '''
+    Puts the canvas, rendered at the internal resolution, on the screen.
+    smooth and fast fill the screen keeping the aspect ratio, the part of the
+    canvas that does not fit is cropped evenly from both sides. integer
+    scales by a whole factor and centers the canvas with black bars.
+    The geometry is computed once per screen size, when the visible part of
+    the canvas is as big as the screen it is copied without resampling.
+    '''
+
+    def __init__(self, screen, internal_resolution=None, mode='smooth') -> None:
+        if mode not in SCALE_MODES:
+            raise ValueError(f'unknown scale mode {mode}, expected one of {SCALE_MODES}')
+        self.screen = screen
+        self.mode = mode
+        # None renders at the screen resolution
+        self.internal_resolution = internal_resolution
+        # same pixel format as the screen, so that copies do not convert
+        self.canvas = pygame.Surface(internal_resolution or screen.get_size()).convert(screen)
+
+        self.screen_size = None
+        self.update_geometry()
+
+    def update_geometry(self):
+        self.screen_size = self.screen.get_size()
+        screen_w, screen_h = self.screen_size
+        if self.internal_resolution is None and self.canvas.get_size() != self.screen_size:
+            self.canvas = pygame.Surface(self.screen_size).convert(self.screen)
+        canvas_w, canvas_h = self.canvas.get_size()
+
+        if self.mode == 'integer':
+            factor = max(1, min(screen_w // canvas_w, screen_h // canvas_h))
+            # canvas bigger than the screen is cropped like in the other modes
+            source_w, source_h = min(canvas_w, screen_w // factor), min(canvas_h, screen_h // factor)
+            target_w, target_h = source_w * factor, source_h * factor
+        else:
+            # the largest part of the canvas with the aspect ratio of the screen
+            scale = max(screen_w / canvas_w, screen_h / canvas_h)
+            source_w = min(canvas_w, round(screen_w / scale))
+            source_h = min(canvas_h, round(screen_h / scale))
+            target_w, target_h = screen_w, screen_h
+
+        self.source_rect = pygame.Rect(
+            (canvas_w - source_w) // 2, (canvas_h - source_h) // 2, source_w, source_h
+        )
+        self.target_rect = pygame.Rect(
+            (screen_w - target_w) // 2, (screen_h - target_h) // 2, target_w, target_h
+        )
+        self.has_bars = self.target_rect.size != self.screen_size
+        self.needs_resample = self.source_rect.size != self.target_rect.size
+
+    def on_event(self, event):
+        if event.type in (pygame.VIDEORESIZE, pygame.WINDOWSIZECHANGED):
+            self.update_geometry()
+
+    def present(self):
+        if self.screen.get_size() != self.screen_size:
+            self.update_geometry()
+
+        if self.has_bars:
+            self.screen.fill((0, 0, 0))
+
+        source = self.canvas.subsurface(self.source_rect)
+        if not self.needs_resample:
+            self.screen.blit(source, self.target_rect)
+            return
+
+        # scaled straight into the screen, no temporary surface
+        target = self.screen.subsurface(self.target_rect)
+        if self.mode == 'smooth':
+            pygame.transform.smoothscale(source, self.target_rect.size, target)
+        else:
+            pygame.transform.scale(source, self.target_rect.size, target)
@@ -0,0 +1,99 @@
+import json
+import time
+from collections import deque
+
+import pygame
+
+
+class FrameProfiler():
+    '''
+    Splits every frame into sections: mark(name) ends the section that
+    started at the previous mark. Keeps the last window frames for the
+    rolling percentiles and totals of the whole session for dump().
+    '''
+
+    def __init__(self, window=300, enabled=False) -> None:
+        self.enabled = enabled
+        self.window = window
+        # section -> deque of the last durations in seconds
+        self.sections = {}
+        # section -> [frames, total seconds, max seconds]
+        self.totals = {}
+        self.frame_start = None
+        self.last_mark = None
+        self.started_time = time.time()
+
+    def start_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.add('frame', now - self.frame_start)
+        self.frame_start = self.last_mark = now
+
+    def mark(self, name):
+        if not self.enabled or self.last_mark is None:
+            return
+        now = time.perf_counter()
+        self.add(name, now - self.last_mark)
+        self.last_mark = now
+
+    def add(self, name, duration):
+        section = self.sections.get(name)
+        if section is None:
+            section = self.sections[name] = deque(maxlen=self.window)
+            self.totals[name] = [0, 0., 0.]
+        section.append(duration)
+
+        totals = self.totals[name]
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] = max(totals[2], duration)
+
+    def get_percentile(self, name, p):
+        durations = sorted(self.sections.get(name, ()))
+        if not durations:
+            return 0.
+        return durations[min(len(durations) - 1, int(len(durations) * p))]
+
+    def get_lines(self):
+        'one line per section, times in ms'
+        return [
+            f'{name}: p50 {1000 * self.get_percentile(name, 0.5):.1f} '
+            f'p95 {1000 * self.get_percentile(name, 0.95):.1f} '
+            f'p99 {1000 * self.get_percentile(name, 0.99):.1f}'
+            for name in self.sections
+        ]
+
+    def render(self, surface, font, pos=(0, 0)):
+        if not self.enabled:
+            return
+        x, y = pos
+        for line in self.get_lines():
+            text = font.render(line, True, (255, 255, 255))
+            background = pygame.Surface(text.get_size())
+            background.set_alpha(160)
+            surface.blit(background, (x, y))
+            surface.blit(text, (x, y))
+            y += text.get_height()
+
+    def to_dict(self):
+        sections = {}
+        for name, (frames, total, max_duration) in self.totals.items():
+            sections[name] = {
+                'frames': frames,
+                'mean_ms': 1000 * total / frames,
+                'max_ms': 1000 * max_duration,
+                'p50_ms': 1000 * self.get_percentile(name, 0.5),
+                'p95_ms': 1000 * self.get_percentile(name, 0.95),
+                'p99_ms': 1000 * self.get_percentile(name, 0.99),
+            }
+        return {
+            'duration_s': time.time() - self.started_time,
+            'window': self.window,
+            'sections': sections,
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
@@ -9,6 +9,21 @@ class Settings:
     server_port: int = 1236
     name: str = 'noname'
     show_debug: bool = False  
+    view_distance: int = 2
+    max_loaded_chunks: int = 64
+    send_rate: int = 20
+    # positions and players over udp when the server offers it
+    use_udp: bool = True
+    # seconds other players are drawn in the past, at least two server ticks
+    interpolation_delay: float = 0.1
+    show_profiler: bool = False
+    profiler_output: str = 'frame_profile.json'
+    log_level: str = 'WARNING'
+    # resolution the world is drawn at, 0 for the screen resolution
+    internal_resolution_x: int = 1920
+    internal_resolution_y: int = 1080
+    # smooth, fast or integer
+    scale_mode: str = 'smooth'
 
 def get_settings():
     def str_to_type(s, t):
@@ -0,0 +1,42 @@
+import secrets
+import struct
+
+# Optional UDP channel next to the TCP connection, for player state only.
+# Every datagram is the session token, the kind and the payload:
+#   HELLO     client -> server, registers the address datagrams are sent to
+#   POSITION  client -> server, common.snapshot.POSITION_RECORD bytes
+#   SNAPSHOT  server -> client, common.snapshot delta bytes
+# Datagrams may be lost or reordered: positions carry the input seq and
+# snapshots are deltas against the last acknowledged one, so stale ones
+# are dropped and lost ones are covered by the next.
+
+HEADER = struct.Struct('!16sB')
+TOKEN_SIZE = 16
+
+HELLO = 0
+POSITION = 1
+SNAPSHOT = 2
+KIND_NAMES = {HELLO: 'hello', POSITION: 'position', SNAPSHOT: 'snapshot'}
+
+# bigger payloads are sent over TCP, they would be fragmented
+MAX_SIZE = 1200
+
+
+class DatagramError(ValueError):
+    pass
+
+
+def new_token():
+    return secrets.token_bytes(TOKEN_SIZE)
+
+
+def pack(kind, token, payload=b''):
+    return HEADER.pack(token, kind) + payload
+
+
+def unpack(data):
+    'returns (kind, token, payload)'
+    if len(data) < HEADER.size:
+        raise DatagramError('truncated datagram')
+    token, kind = HEADER.unpack_from(data, 0)
+    return kind, token, memoryview(data)[HEADER.size:]
@@ -0,0 +1,383 @@
+import socket
+import struct
+import time
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every frame is a header followed by the payload:
+# 4 byte big endian payload length and 1 byte codec the payload is compressed with.
+
+HEADER = struct.Struct('!IB')
+# longer frames are not received, the connection is broken or hostile
+MAX_FRAME_SIZE = 1 << 24
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+# zlib with DICTIONARY preset, good for small protocol messages
+CODEC_ZLIB_DICT = 2
+CODEC_LZ4 = 3
+CODEC_ZSTD = 4
+# not a codec: uncompressed frames between server processes, clients never get them
+CODEC_CONTROL = 255
+
+CODEC_NAMES = {
+    'none': CODEC_NONE,
+    'zlib': CODEC_ZLIB,
+    'zlib_dict': CODEC_ZLIB_DICT,
+    'lz4': CODEC_LZ4,
+    'zstd': CODEC_ZSTD,
+}
+# decoded everywhere, zlib comes with python
+BUILTIN_CODECS = (CODEC_NONE, CODEC_ZLIB, CODEC_ZLIB_DICT)
+
+# Shared by both sides, changing it breaks CODEC_ZLIB_DICT frames of older clients.
+# Pickle opcodes and message kinds of common.protocol, the common.world_format
+# header and runs of block ids / data as they appear in uncompressed chunks.
+DICTIONARY = b''.join([
+    b'\x80\x05\x95', b'\x8c\nworld_info', b'\x8c\x06player', b'\x8c\tplayer_id',
+    b'\x8c\x08position', b'\x8c\x08snapshot', b'\x8c\x0echunks_request', b'\x8c\x06chunks',
+    b'\x94\x8c\x08builtins', b'MWF\x01\x00 \x00\x00\x00 \x00\x00\x00 ',
+] + [bytes([block_id]) * 32 for block_id in (2, 3, 4)] + [
+    bytes([data]) * 32 for data in range(5)
+])
+
+# sendmsg accepts at most IOV_MAX buffers at once
+MAX_BUFFERS_PER_SEND = 512
+
+
+class FrameError(ValueError):
+    'the stream can not be followed, the connection has to be dropped'
+
+
+class CompressionError(FrameError):
+    pass
+
+
+def check_frame_size(msg_length):
+    if msg_length > MAX_FRAME_SIZE:
+        raise FrameError(f'frame of {msg_length} bytes, at most {MAX_FRAME_SIZE} are received')
+
+
+def is_codec_available(codec):
+    if codec == CODEC_LZ4:
+        return lz4 is not None
+    if codec == CODEC_ZSTD:
+        return zstandard is not None
+    return codec in CODEC_NAMES.values()
+
+
+def get_available_codecs():
+    'codecs that can be decoded here, sent to the server in the handshake'
+    return [codec for codec in CODEC_NAMES.values() if is_codec_available(codec)]
+
+
+def compress(codec, data, level):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, level)
+    if codec == CODEC_ZLIB_DICT:
+        compressor = zlib.compressobj(level, zdict=DICTIONARY)
+        return compressor.compress(data) + compressor.flush()
+    if codec == CODEC_LZ4:
+        return lz4.frame.compress(data, compression_level=level)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise CompressionError(f'unknown codec {codec}')
+
+
+def decompress(codec, data):
+    if codec == CODEC_NONE:
+        return data
+    try:
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(data)
+        if codec == CODEC_ZLIB_DICT:
+            decompressor = zlib.decompressobj(zdict=DICTIONARY)
+            return decompressor.decompress(data) + decompressor.flush()
+        if codec == CODEC_LZ4 and lz4 is not None:
+            return lz4.frame.decompress(data)
+        if codec == CODEC_ZSTD and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(data)
+    except Exception as e:
+        # every library has its own errors for corrupt data
+        raise CompressionError(f'corrupt codec {codec} payload: {e}') from e
+    raise CompressionError(f'codec {codec} is not supported here')
+
+
+class CompressionStats():
+    def __init__(self) -> None:
+        # codec -> [frames, bytes before, bytes after, seconds]
+        self.by_codec = {}
+
+    def add(self, codec, raw_size, compressed_size, seconds):
+        stats = self.by_codec.setdefault(codec, [0, 0, 0, 0.])
+        stats[0] += 1
+        stats[1] += raw_size
+        stats[2] += compressed_size
+        stats[3] += seconds
+
+    def get_ratio(self):
+        raw_size = sum(stats[1] for stats in self.by_codec.values())
+        compressed_size = sum(stats[2] for stats in self.by_codec.values())
+        return compressed_size / raw_size if raw_size else 1.
+
+    def get_cpu_time(self):
+        return sum(stats[3] for stats in self.by_codec.values())
+
+    def __repr__(self):
+        return (
+            f'ratio: {self.get_ratio():.3f}, cpu: {1000 * self.get_cpu_time():.1f} ms, '
+            f'frames: {dict((codec, stats[0]) for codec, stats in self.by_codec.items())}'
+        )
+
+
+class CompressionPolicy():
+    '''
+    Picks a codec for every frame:
+    smaller than min_size - sent as is,
+    smaller than dictionary_max_size - zlib with the preset dictionary,
+    bigger - the preferred codec, zlib when it is not installed.
+    Frames that do not get smaller are sent as is.
+    '''
+
+    def __init__(
+        self, codec=CODEC_ZLIB, level=1, min_size=512, dictionary_max_size=16384, stats=None
+    ) -> None:
+        if not is_codec_available(codec):
+            codec = CODEC_ZLIB
+        self.codec = codec
+        self.level = level
+        self.min_size = min_size
+        self.dictionary_max_size = dictionary_max_size
+        self.stats = stats if stats is not None else CompressionStats()
+
+    def for_codecs(self, codecs):
+        '''
+        the policy for a peer that decodes codecs, None for peers that did
+        not say, zlib instead of the preferred codec when it is not in them
+        '''
+        if codecs is None:
+            codecs = BUILTIN_CODECS
+        codec = self.codec if self.codec in codecs else CODEC_ZLIB
+        # one stats for all peers
+        return CompressionPolicy(codec, self.level, self.min_size, self.dictionary_max_size, self.stats)
+
+    def choose_codec(self, data):
+        if self.codec == CODEC_NONE or len(data) < self.min_size:
+            return CODEC_NONE
+        if len(data) < self.dictionary_max_size:
+            return CODEC_ZLIB_DICT
+        return self.codec
+
+    def compress(self, data):
+        'returns (codec, payload)'
+        codec = self.choose_codec(data)
+        if codec == CODEC_NONE:
+            return CODEC_NONE, data
+
+        start = time.process_time()
+        # zlib levels go up to 9, lz4 and zstd have their own ranges
+        level = self.level if codec not in (CODEC_ZLIB, CODEC_ZLIB_DICT) else min(self.level, 9)
+        compressed = compress(codec, data, level)
+        self.stats.add(codec, len(data), len(compressed), time.process_time() - start)
+
+        if len(compressed) >= len(data):
+            return CODEC_NONE, data
+        return codec, compressed
+
+
+default_policy = CompressionPolicy()
+
+
+def encode_frame(data, policy=None):
+    'returns (header, payload) ready to be sent'
+    codec, data = (policy or default_policy).compress(data)
+    return HEADER.pack(len(data), codec), data
+
+
+def encode_control_frame(data):
+    'returns a CODEC_CONTROL frame as one bytes object'
+    return HEADER.pack(len(data), CODEC_CONTROL) + data
+
+
+def decode_payload(codec, buf):
+    return decompress(codec, buf)
+
+
+def send_frames(s: socket.socket, payloads, policy=None):
+    'sends all payloads with as few syscalls as possible, handles partial writes, returns bytes sent'
+    buffers = []
+    for payload in payloads:
+        buffers.extend(encode_frame(payload, policy))
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    total = sum(len(buffer) for buffer in buffers)
+
+    # windows sockets have no sendmsg
+    if not hasattr(s, 'sendmsg'):
+        s.sendall(b''.join(buffers))
+        return total
+
+    while buffers:
+        sent = s.sendmsg(buffers[:MAX_BUFFERS_PER_SEND])
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+    return total
+
+
+class FrameSplitter():
+    '''
+    Splits a byte stream into whole frames without decoding them,
+    for relaying frames from one connection to another
+    '''
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        'returns [(codec, frame with its header)] of the frames completed by data'
+        self.buffer += data
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= HEADER.size:
+            msg_length, codec = HEADER.unpack_from(self.buffer, start)
+            check_frame_size(msg_length)
+            end = start + HEADER.size + msg_length
+            if end > len(self.buffer):
+                break
+            frames.append((codec, bytes(self.buffer[start:end])))
+            start = end
+        del self.buffer[:start]
+        return frames
+
+
+def recv_exactly(s: socket.socket, buffer):
+    'fills buffer from the socket, returns False if the connection was closed'
+    view = memoryview(buffer)
+    received = 0
+    while received < len(view):
+        n = s.recv_into(view[received:])
+        if n == 0:
+            return False
+        received += n
+    return True
+
+
+def recv_frame(s: socket.socket):
+    'blocks until one full frame is read, never reads past it'
+    header = bytearray(HEADER.size)
+    if not recv_exactly(s, header):
+        return None
+    msg_length, codec = HEADER.unpack(header)
+    check_frame_size(msg_length)
+
+    buf = bytearray(msg_length)
+    if not recv_exactly(s, buf):
+        return None
+    return decode_payload(codec, buf)
+
+
+class FrameDecoder():
+    '''
+    Incremental decoder, bytes come from recv_into or feed and complete
+    frames are taken with frames(). Frames larger than the buffer are read
+    into their own preallocated bytearray and returned without a copy.
+    '''
+
+    def __init__(self, buffer_size=65536) -> None:
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+        # frame being read into its own buffer
+        self.large_frame = None
+        self.large_frame_codec = CODEC_NONE
+        self.large_frame_filled = 0
+
+        self.pending_frames = []
+        self.closed = False
+
+    def get_free_view(self):
+        if self.large_frame is not None:
+            return memoryview(self.large_frame)[self.large_frame_filled:]
+
+        if self.end == len(self.buffer):
+            # move the unfinished frame to the start of the buffer
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
+        return self.view[self.end:]
+
+    def on_received(self, n):
+        if self.large_frame is not None:
+            self.large_frame_filled += n
+            if self.large_frame_filled < len(self.large_frame):
+                return
+            self.pending_frames.append(decode_payload(self.large_frame_codec, self.large_frame))
+            self.large_frame = None
+        else:
+            self.end += n
+        self.parse()
+
+    def parse(self):
+        while self.end - self.start >= HEADER.size:
+            msg_length, codec = HEADER.unpack_from(self.buffer, self.start)
+            check_frame_size(msg_length)
+            frame_start = self.start + HEADER.size
+
+            if msg_length > len(self.buffer) - HEADER.size:
+                # the rest of the frame is received straight into its own buffer
+                self.large_frame = bytearray(msg_length)
+                self.large_frame_codec = codec
+                available = min(msg_length, self.end - frame_start)
+                self.large_frame[:available] = self.view[frame_start:frame_start + available]
+                self.large_frame_filled = available
+                self.start = frame_start + available
+                # it does not fit in the buffer, so it can not be complete yet
+                break
+
+            if self.end - frame_start < msg_length:
+                break
+            self.pending_frames.append(
+                decode_payload(codec, bytes(self.view[frame_start:frame_start + msg_length]))
+            )
+            self.start = frame_start + msg_length
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def recv_into(self, s: socket.socket):
+        'reads what is available from the socket, returns the number of bytes or 0 if closed'
+        n = s.recv_into(self.get_free_view())
+        if n == 0:
+            self.closed = True
+        else:
+            self.on_received(n)
+        return n
+
+    def feed(self, data):
+        data = memoryview(data).cast('B')
+        while len(data):
+            free = self.get_free_view()
+            n = min(len(free), len(data))
+            free[:n] = data[:n]
+            data = data[n:]
+            self.on_received(n)
+
+    def frames(self):
+        'complete frames received so far'
+        frames, self.pending_frames = self.pending_frames, []
+        return frames
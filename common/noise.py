@@ -0,0 +1,111 @@
+import math
+
+import numpy as np
+
+# Seeded gradient noise that can be computed for any rectangle on its own:
+# gradients come from a hash of the lattice coordinate instead of a
+# random array, so neighbouring rectangles match at their borders.
+
+# octaves of fbm_noise_2d get unrelated gradients
+OCTAVE_SEED_STEP = 0x9E3779B97F4A7C15
+
+
+def hash_2d(seed, x, y):
+    'uint64 hash of integer arrays x, y (broadcast together)'
+    x = np.asarray(x, dtype=np.int64).astype(np.uint64)
+    y = np.asarray(y, dtype=np.int64).astype(np.uint64)
+    # products wrap around on purpose, numpy warns about it for single numbers
+    with np.errstate(over='ignore'):
+        h = x * np.uint64(0x9E3779B97F4A7C15) ^ y * np.uint64(0xC2B2AE3D27D4EB4F) ^ np.uint64(seed & 0xFFFFFFFFFFFFFFFF)
+
+        # splitmix64 finalizer
+        h = h ^ (h >> np.uint64(30))
+        h = h * np.uint64(0xBF58476D1CE4E5B9)
+        h = h ^ (h >> np.uint64(27))
+        h = h * np.uint64(0x94D049BB133111EB)
+        h = h ^ (h >> np.uint64(31))
+    return h
+
+
+def fade(t):
+    return 6*t**5 - 15*t**4 + 10*t**3
+
+
+def split_period(period):
+    'period for both axes'
+    if np.ndim(period) == 0:
+        return period, period
+    return period[0], period[1]
+
+
+def perlin_noise_2d(seed, origin, shape, period, dtype=np.float32):
+    '''
+    Perlin noise for the points [origin[0], origin[0] + shape[0]) x
+    [origin[1], origin[1] + shape[1]), with one lattice cell every period points,
+    period is a number or (period_x, period_y)
+    '''
+    period_x, period_y = split_period(period)
+    # lattice positions are found in float64, only the fractions are dtype
+    xs = (np.arange(shape[0]) + origin[0]) / period_x
+    ys = (np.arange(shape[1]) + origin[1]) / period_y
+    x0 = np.floor(xs).astype(np.int64)
+    y0 = np.floor(ys).astype(np.int64)
+    fx = (xs - x0).astype(dtype)[:, None]
+    fy = (ys - y0).astype(dtype)[None, :]
+
+    # gradients of every lattice corner the rectangle touches
+    lattice_x = np.arange(x0[0], x0[-1] + 2)
+    lattice_y = np.arange(y0[0], y0[-1] + 2)
+    angles = hash_2d(seed, lattice_x[:, None], lattice_y[None, :]) * (2 * np.pi / 2**64)
+    gradients_x = np.cos(angles).astype(dtype)
+    gradients_y = np.sin(angles).astype(dtype)
+
+    ix = (x0 - lattice_x[0])[:, None]
+    iy = (y0 - lattice_y[0])[None, :]
+
+    def ramp(dx, dy):
+        return (
+            (fx - dx) * gradients_x[ix + dx, iy + dy]
+            + (fy - dy) * gradients_y[ix + dx, iy + dy]
+        )
+
+    # the fades only depend on one axis
+    tx, ty = fade(fx), fade(fy)
+    n0 = ramp(0, 0)
+    n0 += tx * (ramp(1, 0) - n0)
+    n1 = ramp(0, 1)
+    n1 += tx * (ramp(1, 1) - n1)
+    n0 += ty * (n1 - n0)
+    n0 *= math.sqrt(2)
+    return n0
+
+
+def fbm_noise_2d(
+    seed, origin, shape, period, octaves=1, persistence=0.5, lacunarity=2.,
+    dtype=np.float32, tile_size=256
+):
+    '''
+    Fractal noise, a sum of octaves of perlin_noise_2d. The first octave has
+    amplitude 1, every next one has persistence times the amplitude and
+    period / lacunarity. The map is computed in tile_size x tile_size tiles,
+    so temporaries do not grow with shape.
+    '''
+    period_x, period_y = split_period(period)
+    noise = np.zeros(shape, dtype=dtype)
+
+    for x in range(0, shape[0], tile_size):
+        for y in range(0, shape[1], tile_size):
+            tile = noise[x:x + tile_size, y:y + tile_size]
+            amplitude = 1.
+            for octave in range(octaves):
+                scale = lacunarity ** octave
+                tile += amplitude * perlin_noise_2d(
+                    seed + octave * OCTAVE_SEED_STEP,
+                    (origin[0] + x, origin[1] + y),
+                    tile.shape,
+                    (period_x / scale, period_y / scale),
+                    dtype
+                )
+                amplitude *= persistence
+
+    return noise
@@ -0,0 +1,99 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common.world_format import HEADER, CHUNK_HEADER, BLOCK_DTYPE, FormatError, decode_chunk
+
+# Chunk generation and decoding in worker processes. Work is sent in batches
+# of chunk positions or encoded chunk records, every batch comes back as two
+# (n, chunk_size, chunk_size) uint8 arrays, which are pickled as plain buffers.
+
+
+def generate_batch(generator, positions):
+    size = generator.chunk_size
+    ids = np.empty((len(positions), size, size), dtype=BLOCK_DTYPE)
+    data = np.empty((len(positions), size, size), dtype=BLOCK_DTYPE)
+    for i, pos in enumerate(positions):
+        ids[i], data[i] = generator.generate_chunk(pos)
+    return positions, ids, data
+
+
+def decode_batch(records, chunk_size):
+    'records: bytes of consecutive encoded chunks'
+    view = memoryview(records)
+    positions = []
+    ids = []
+    data = []
+    offset = 0
+    while offset < len(view):
+        (pos, chunk_ids, chunk_data), offset = decode_chunk(view, offset, chunk_size)
+        positions.append(pos)
+        ids.append(chunk_ids)
+        data.append(chunk_data)
+
+    shape = (0, chunk_size, chunk_size)
+    return (
+        positions,
+        np.stack(ids) if ids else np.empty(shape, dtype=BLOCK_DTYPE),
+        np.stack(data) if data else np.empty(shape, dtype=BLOCK_DTYPE)
+    )
+
+
+def split_records(buffer, batch_size):
+    'splits encoded world into (chunk_size, chunks_count, [records of batch_size chunks])'
+    view = memoryview(buffer)
+    if len(view) < HEADER.size:
+        raise FormatError('truncated header')
+    _, _, chunk_size, count_x, count_y, chunks_number = HEADER.unpack_from(view, 0)
+
+    batches = []
+    offset = batch_start = HEADER.size
+    for i in range(chunks_number):
+        if offset + CHUNK_HEADER.size > len(view):
+            raise FormatError('truncated chunk header')
+        *_, length = CHUNK_HEADER.unpack_from(view, offset)
+        offset += CHUNK_HEADER.size + length
+        if (i + 1) % batch_size == 0 or i + 1 == chunks_number:
+            batches.append(bytes(view[batch_start:offset]))
+            batch_start = offset
+
+    chunks_count = (count_x, count_y) if count_x >= 0 else None
+    return chunk_size, chunks_count, batches
+
+
+class ChunkPool():
+    '''
+    Bounded pool of worker processes, results are yielded per batch as
+    (positions, ids, data) in the order the batches were submitted.
+    '''
+
+    def __init__(self, workers=None, batch_size=64) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.executor = ProcessPoolExecutor(self.workers)
+
+    def get_batches(self, items):
+        # at least one batch per worker so that small requests are spread too
+        batch_size = max(1, min(self.batch_size, -(-len(items) // self.workers)))
+        return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+    def generate(self, generator, positions):
+        batches = self.get_batches(list(positions))
+        return self.executor.map(generate_batch, [generator] * len(batches), batches)
+
+    def decode(self, buffer):
+        'returns (chunk_size, chunks_count, batches) of an encoded world'
+        chunk_size, chunks_count, records = split_records(buffer, self.batch_size)
+        return chunk_size, chunks_count, self.executor.map(
+            decode_batch, records, [chunk_size] * len(records)
+        )
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,193 @@
+import heapq
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+# Flow fields over the speed multipliers of World.get_chunk_speeds. A field
+# is made once per goal by Dijkstra from the goal over the blocks of the
+# chunks around it, every entity heading to that goal then reads its next
+# step from the field, so thousands of entities cost a few array lookups.
+
+# (dx, dy) of the 8 neighbours of a block, index 8 is staying in place
+DIRECTIONS = np.array(
+    ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1), (0, 0)),
+    dtype=np.int8
+)
+# the neighbour is blocked when its speed multiplier is lower
+MIN_SPEED = 0.01
+
+
+class FlowField():
+    '''
+    Time to reach the goal from every block of a square of chunks, moving
+    through a block takes 1 / its speed multiplier, diagonal steps sqrt(2)
+    times longer. directions has the index in DIRECTIONS of the step
+    towards the goal, 8 at the goal and where it can not be reached.
+    '''
+
+    def __init__(self, goal, origin, speeds) -> None:
+        # world block coordinates
+        self.goal = goal
+        self.origin = origin
+        self.shape = speeds.shape
+        self.distances = self.get_distances(speeds)
+        self.directions = self.get_directions()
+
+    def get_distances(self, speeds):
+        width, height = self.shape
+        costs = np.where(speeds >= MIN_SPEED, 1 / np.maximum(speeds, MIN_SPEED), np.inf).ravel().tolist()
+        distances = [math.inf] * (width * height)
+
+        # flat index = x * height + y, the same as ravel() of the (width, height) arrays
+        neighbours = [
+            (dx * height + dy, dx, dy, math.hypot(dx, dy) / 2)
+            for dx, dy in DIRECTIONS[:8].tolist()
+        ]
+        goal = (self.goal[0] - self.origin[0]) * height + (self.goal[1] - self.origin[1])
+        distances[goal] = 0.
+        queue = [(0., goal)]
+        while queue:
+            distance, index = heapq.heappop(queue)
+            if distance > distances[index]:
+                continue
+            x, y = divmod(index, height)
+            cost = costs[index]
+            for offset, dx, dy, step in neighbours:
+                if not (0 <= x + dx < width and 0 <= y + dy < height):
+                    continue
+                neighbour = index + offset
+                # half of the time in each of the two blocks
+                new_distance = distance + step * (cost + costs[neighbour])
+                if new_distance < distances[neighbour]:
+                    distances[neighbour] = new_distance
+                    heapq.heappush(queue, (new_distance, neighbour))
+
+        return np.array(distances, dtype=np.float32).reshape(self.shape)
+
+    def get_directions(self):
+        'index of the neighbour nearest to the goal for every block, all blocks at once'
+        padded = np.pad(self.distances, 1, constant_values=np.inf)
+        width, height = self.shape
+        candidates = np.stack([
+            padded[1 + dx:1 + dx + width, 1 + dy:1 + dy + height] for dx, dy in DIRECTIONS.tolist()
+        ])
+        directions = np.argmin(candidates, axis=0).astype(np.int8)
+        directions[np.isinf(self.distances)] = 8
+        return directions
+
+    def contains(self, blocks):
+        local = blocks - self.origin
+        return (
+            (local[:, 0] >= 0) & (local[:, 0] < self.shape[0]) &
+            (local[:, 1] >= 0) & (local[:, 1] < self.shape[1])
+        )
+
+    def get_steps(self, blocks):
+        '(dx, dy) block steps towards the goal of an (n, 2) array of blocks, (0, 0) outside the field'
+        inside = self.contains(blocks)
+        local = np.clip(blocks - self.origin, 0, np.array(self.shape) - 1)
+        indexes = np.where(inside, self.directions[local[:, 0], local[:, 1]], 8)
+        return DIRECTIONS[indexes]
+
+
+class PathfindingService():
+    '''
+    Flow fields of the goals entities are heading to, shared by all of them.
+    Fields cover the chunks in radius around the goal, the least recently
+    used ones are dropped above max_fields. A field is made again when one
+    of its chunks is reloaded or invalidate_chunk is called for it.
+    '''
+
+    def __init__(self, world, radius=2, max_fields=64) -> None:
+        self.world = world
+        self.radius = radius
+        self.max_fields = max_fields
+        # goal block -> (FlowField, {chunk_pos: (chunk, speeds) it was made from})
+        self.fields = OrderedDict()
+        # chunk_pos -> goals of the fields covering it
+        self.goals_by_chunk = {}
+
+    def get_goal_block(self, goal):
+        return (math.floor(goal[0]) // 64, math.floor(goal[1]) // 64)
+
+    def make_field(self, goal_block):
+        size = self.world.CHUNK_SIZE
+        goal_chunk = (goal_block[0] // size, goal_block[1] // size)
+        side = (2 * self.radius + 1) * size
+        origin = ((goal_chunk[0] - self.radius) * size, (goal_chunk[1] - self.radius) * size)
+
+        # chunks outside the world are blocked
+        speeds = np.zeros((side, side), dtype=np.float32)
+        chunks = {}
+        for i in range(2 * self.radius + 1):
+            for j in range(2 * self.radius + 1):
+                chunk_pos = (goal_chunk[0] - self.radius + i, goal_chunk[1] - self.radius + j)
+                chunk_speeds = self.world.get_chunk_speeds(chunk_pos)
+                chunks[chunk_pos] = (self.world.chunks.get(chunk_pos), chunk_speeds)
+                if chunk_speeds is not None:
+                    speeds[i * size:(i + 1) * size, j * size:(j + 1) * size] = chunk_speeds
+
+        return FlowField(goal_block, origin, speeds), chunks
+
+    def is_valid(self, chunks):
+        # reloaded chunks are new objects, changed ones get new speeds arrays
+        for pos, (chunk, speeds) in chunks.items():
+            if self.world.chunks.get(pos) is not chunk or (chunk is not None and chunk.speeds is not speeds):
+                return False
+        return True
+
+    def get_field(self, goal):
+        'flow field towards the block at goal, in pixels'
+        goal_block = self.get_goal_block(goal)
+        cached = self.fields.get(goal_block)
+        if cached is not None and self.is_valid(cached[1]):
+            self.fields.move_to_end(goal_block)
+            return cached[0]
+
+        self.remove_field(goal_block)
+        field, chunks = self.make_field(goal_block)
+        self.fields[goal_block] = (field, chunks)
+        for chunk_pos in chunks:
+            self.goals_by_chunk.setdefault(chunk_pos, set()).add(goal_block)
+        while len(self.fields) > self.max_fields:
+            self.remove_field(next(iter(self.fields)))
+        return field
+
+    def remove_field(self, goal_block):
+        cached = self.fields.pop(goal_block, None)
+        if cached is None:
+            return
+        for chunk_pos in cached[1]:
+            goals = self.goals_by_chunk.get(chunk_pos)
+            goals.discard(goal_block)
+            if not goals:
+                del self.goals_by_chunk[chunk_pos]
+
+    def invalidate_chunk(self, chunk_pos):
+        'drops the fields made from the chunk, for changes that keep its speeds array'
+        for goal_block in list(self.goals_by_chunk.get(chunk_pos, ())):
+            self.remove_field(goal_block)
+
+    def get_directions(self, positions, goal):
+        '''
+        unit vectors from an (n, 2) array of positions in pixels towards the
+        next block on the way to goal, (0, 0) at the goal and where the way
+        is unknown (blocked or further than radius chunks from the goal)
+        '''
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        field = self.get_field(goal)
+        blocks = np.floor_divide(positions, 64).astype(np.int64)
+        steps = field.get_steps(blocks)
+
+        # towards the center of the next block, so entities do not cut corners
+        targets = (blocks + steps) * 64 + 32
+        vectors = np.where(steps.any(axis=1)[:, None], targets - positions, 0)
+        norms = np.hypot(vectors[:, 0], vectors[:, 1])
+        return (vectors / np.maximum(norms, 1e-9)[:, None]).astype(np.float32)
+
+    def get_velocities(self, positions, goal, speed):
+        'get_directions scaled by speed and the speed multiplier of the block every entity is on'
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        multipliers = self.world.get_speed_multipliers(positions)
+        return self.get_directions(positions, goal) * (speed * multipliers)[:, None]
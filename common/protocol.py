@@ -0,0 +1,60 @@
+import cloudpickle as pickle
+
+# every tcp message is a pickled (kind, payload) tuple
+
+# server -> client on connect: (chunk_size, chunks_count)
+WORLD_INFO = 'world_info'
+# client -> server once after WORLD_INFO: (Player, codecs of common.framing the
+# client decodes), a Player alone from clients that only decode the builtin ones
+PLAYER = 'player'
+# server -> client, the reply to PLAYER: numeric id of the player
+PLAYER_ID = 'player_id'
+# server -> client after PLAYER_ID when the udp channel is enabled:
+# (token, udp_port), see common.datagram
+SESSION = 'session'
+# client -> server: common.snapshot.POSITION_RECORD bytes
+POSITION = 'position'
+# server -> client every tick: common.snapshot delta bytes
+SNAPSHOT = 'snapshot'
+# client -> server: [(chunk_x, chunk_y), ...]
+CHUNKS_REQUEST = 'chunks_request'
+# server -> client: chunks encoded with common.world_format
+CHUNKS = 'chunks'
+# client -> server: (block_x, block_y, id, data), world block coordinates
+SET_BLOCK = 'set_block'
+# server -> client every tick something changed: common.world_format changes
+# of the chunks the client has
+BLOCKS = 'blocks'
+
+# between the processes of the sharded server (server/sharding.py), never sent to clients
+# front-end -> shard instead of PLAYER: (player, player_id, seq of the last snapshot
+# the client got from its previous shard, positions of the chunks the client has,
+# codecs the client decodes)
+JOIN = 'join'
+# shard -> front-end as a framing.CODEC_CONTROL frame:
+# (shard index, player, last seq, positions of the chunks the client has)
+HANDOFF = 'handoff'
+# shard -> shard over local udp every tick: (shard index, [(player_id, x, y, name)])
+GHOSTS = 'ghosts'
+# shard -> shard over local udp when chunks of its regions changed:
+# (shard index, [(chunk_pos, version, common.world_format chunk record)])
+CHUNK_UPDATES = 'chunk_updates'
+# shard -> shard over local udp every chunk_check_period: (shard index,
+# [(chunk_pos, version the copy was sent at, None if it was read from disk)]),
+# the owner answers with CHUNK_UPDATES of the chunks it has at another version
+CHUNK_VERSIONS = 'chunk_versions'
+
+
+def pack(kind, payload=None):
+    return pickle.dumps((kind, payload))
+
+
+def unpack(data):
+    return pickle.loads(data)
+
+
+def unpack_player(payload):
+    '(player, codecs) of a PLAYER payload, codecs is None when the client did not send them'
+    if isinstance(payload, tuple):
+        return payload
+    return payload, None
@@ -0,0 +1,360 @@
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+from common.world_format import encode_chunk, decode_chunk
+
+# World directory:
+#   world.info - magic, version, chunk size, chunks count (x, y, -1 for infinite
+#                worlds), has seed, seed of the chunk generator
+#   r.<x>.<y>.mwr - region files with REGION_SIZE x REGION_SIZE chunks each
+#
+# Region file: header (magic, version, chunk size, region size), then an index
+# of region_size * region_size entries (offset, length) followed by chunk
+# records in common.world_format chunk encoding. Length 0 means no chunk.
+#
+# Dirty chunks are appended at the end of the file and fsynced before their
+# index entries are overwritten, so a crash leaves either the old or the new
+# chunk. Space of replaced records is reclaimed by compact().
+#
+# Reads never wait for a write to reach the disk: records are appended and
+# fsynced without locks, readers only see them once the index entries in
+# memory are replaced, under the lock of the region.
+#
+# A region is written by one process only, the shards of the sharded server
+# read the regions of the others. Readers load the index again when the file
+# was changed or replaced since they last read it.
+
+REGION_SIZE = 16
+
+META = struct.Struct('!3sBHiiBQ')
+META_MAGIC = b'MWI'
+META_VERSION = 2
+# without the generator seed, every chunk is in the region files
+META_V1 = struct.Struct('!3sBHii')
+
+HEADER = struct.Struct('!3sBHH')
+MAGIC = b'MWR'
+VERSION = 1
+
+INDEX_ENTRY = struct.Struct('!QI')
+# in ns, coarser than the mtime of most file systems
+MTIME_RESOLUTION = 10 ** 9
+
+
+class RegionError(ValueError):
+    pass
+
+
+def is_world_dir(path):
+    return os.path.exists(os.path.join(path, 'world.info'))
+
+
+def write_file(path, data):
+    'writes data to path and waits until it is on disk'
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def replace_file(path, data):
+    'writes data to path atomically'
+    tmp_path = path + '.tmp'
+    write_file(tmp_path, data)
+    os.replace(tmp_path, path)
+
+
+class RegionFile():
+    def __init__(self, path, chunk_size, region_size=REGION_SIZE) -> None:
+        self.path = path
+        self.chunk_size = chunk_size
+        self.region_size = region_size
+        self.index_offset = HEADER.size
+
+        if not os.path.exists(path):
+            header = HEADER.pack(MAGIC, VERSION, chunk_size, region_size)
+            replace_file(path, header + bytes(INDEX_ENTRY.size * region_size * region_size))
+
+        self.file = open(path, 'r+b')
+        magic, version, file_chunk_size, file_region_size = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise RegionError(f'{path} is not a region file')
+        if (file_chunk_size, file_region_size) != (chunk_size, region_size):
+            raise RegionError(f'{path} has chunk size {file_chunk_size}, region size {file_region_size}')
+
+        self.index = [
+            INDEX_ENTRY.unpack(self.file.read(INDEX_ENTRY.size))
+            for _ in range(region_size * region_size)
+        ]
+        self.map = None
+        # (inode, size, mtime) of the file the index was read from
+        self.file_state = self.get_file_state()
+        # guards index, map and file for readers, one writer at a time is up to the caller
+        self.lock = threading.Lock()
+
+    def get_file_state(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def reload_index(self):
+        'reads the index again if another process changed the file, call with lock held'
+        state = self.get_file_state()
+        if state == self.file_state:
+            return
+        if state[0] != os.fstat(self.file.fileno()).st_ino:
+            # compacted, the old file is gone
+            self.close()
+            self.file = open(self.path, 'r+b')
+
+        # through the map, the file position belongs to the writer
+        source = self.get_map()
+        self.index = [
+            INDEX_ENTRY.unpack_from(source, self.index_offset + i * INDEX_ENTRY.size)
+            for i in range(len(self.index))
+        ]
+        # the index entries are written after the records, within the
+        # resolution of mtime they do not change the state, it is read again
+        self.file_state = state if time.time_ns() - state[2] > MTIME_RESOLUTION else None
+
+    def get_map(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if self.map is None or len(self.map) != size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def get_used_size(self):
+        return sum(length for _, length in self.index)
+
+    def read_chunk(self, local_pos):
+        'returns (ids, data) or None'
+        with self.lock:
+            self.reload_index()
+            offset, length = self.index[local_pos[0] * self.region_size + local_pos[1]]
+            if length == 0:
+                return None
+
+            view = memoryview(self.get_map())[:offset + length]
+            (_, ids, data), _ = decode_chunk(view, offset, self.chunk_size)
+            # copies, the map is closed when the file grows and must not be referenced
+            ids, data = np.array(ids), np.array(data)
+            del view
+        return ids, data
+
+    def write_chunks(self, chunks):
+        'chunks: {local_pos: (ids, data)}'
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+
+        entries = {}
+        for local_pos, (ids, data) in chunks.items():
+            record = encode_chunk((0, 0), ids, data)
+            self.file.write(record)
+            entries[local_pos] = (offset, len(record))
+            offset += len(record)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        for (x, y), entry in entries.items():
+            i = x * self.region_size + y
+            self.file.seek(self.index_offset + i * INDEX_ENTRY.size)
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        # readers see the new records from here on
+        with self.lock:
+            for (x, y), entry in entries.items():
+                self.index[x * self.region_size + y] = entry
+            self.file_state = self.get_file_state()
+
+        if offset > 2 * self.get_used_size() + (1 << 16):
+            self.compact()
+
+    def compact(self):
+        'rewrites the region without replaced records, readers only wait for the files to be swapped'
+        index_size = INDEX_ENTRY.size * len(self.index)
+        offset = HEADER.size + index_size
+
+        index = []
+        records = []
+        with self.lock:
+            source = self.get_map()
+            for entry_offset, length in self.index:
+                if length == 0:
+                    index.append((0, 0))
+                    continue
+                records.append(source[entry_offset:entry_offset + length])
+                index.append((offset, length))
+                offset += length
+
+        header = HEADER.pack(MAGIC, VERSION, self.chunk_size, self.region_size)
+        data = b''.join([header] + [INDEX_ENTRY.pack(*entry) for entry in index] + records)
+        tmp_path = self.path + '.tmp'
+        write_file(tmp_path, data)
+
+        with self.lock:
+            self.close()
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, 'r+b')
+            self.index = index
+            self.file_state = self.get_file_state()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class RegionStorage():
+    '''
+    Chunks of a world stored in region files. Reads are lazy, one chunk at a
+    time, writes can be queued to a background thread with save_chunks_async.
+    '''
+
+    def __init__(self, path, chunk_size, region_size=REGION_SIZE) -> None:
+        self.path = path
+        self.chunk_size = chunk_size
+        self.region_size = region_size
+        os.makedirs(path, exist_ok=True)
+
+        self.regions = {}
+        # chunks queued for writing, they are newer than what is on disk
+        self.pending = {}
+        # guards pending and regions, never held during file io
+        self.lock = threading.Lock()
+        # one writer at a time
+        self.write_lock = threading.Lock()
+
+        self.queue = queue.Queue()
+        self.writer_thread = threading.Thread(target=self.write_queued, daemon=True)
+        self.writer_thread.start()
+
+    def get_meta_path(self):
+        return os.path.join(self.path, 'world.info')
+
+    def save_meta(self, chunks_count, seed=None):
+        if chunks_count is None:
+            chunks_count = (-1, -1)
+        replace_file(
+            self.get_meta_path(),
+            META.pack(
+                META_MAGIC, META_VERSION, self.chunk_size, chunks_count[0], chunks_count[1],
+                seed is not None, seed or 0
+            )
+        )
+
+    def load_meta(self):
+        'returns (chunks_count, seed)'
+        with open(self.get_meta_path(), 'rb') as f:
+            data = f.read()
+
+        if data[3:4] == bytes([1]):
+            magic, version, chunk_size, count_x, count_y = META_V1.unpack(data)
+            has_seed, seed = False, 0
+        else:
+            magic, version, chunk_size, count_x, count_y, has_seed, seed = META.unpack(data)
+        if magic != META_MAGIC or version not in (1, META_VERSION):
+            raise RegionError(f'{self.path} is not a world')
+        if chunk_size != self.chunk_size:
+            raise RegionError(f'{self.path} has chunk size {chunk_size}')
+
+        chunks_count = (count_x, count_y) if count_x >= 0 else None
+        return chunks_count, (seed if has_seed else None)
+
+    def get_region_path(self, region_pos):
+        return os.path.join(self.path, f'r.{region_pos[0]}.{region_pos[1]}.mwr')
+
+    def get_region(self, region_pos):
+        'the region if its file exists, call with lock held'
+        region = self.regions.get(region_pos)
+        if region is None:
+            path = self.get_region_path(region_pos)
+            if not os.path.exists(path):
+                return None
+            region = RegionFile(path, self.chunk_size, self.region_size)
+            self.regions[region_pos] = region
+        return region
+
+    def create_region(self, region_pos):
+        'the region, its file is created and fsynced outside of lock if needed'
+        with self.lock:
+            region = self.get_region(region_pos)
+        if region is not None:
+            return region
+
+        region = RegionFile(self.get_region_path(region_pos), self.chunk_size, self.region_size)
+        with self.lock:
+            # a reader opened the new file in the meantime
+            if region_pos in self.regions:
+                region.close()
+                return self.regions[region_pos]
+            self.regions[region_pos] = region
+        return region
+
+    def split_pos(self, pos):
+        'chunk position -> (region position, position in the region)'
+        region_pos = (pos[0] // self.region_size, pos[1] // self.region_size)
+        return region_pos, (pos[0] % self.region_size, pos[1] % self.region_size)
+
+    def load_chunk(self, pos):
+        'returns (ids, data) or None'
+        region_pos, local_pos = self.split_pos(pos)
+        with self.lock:
+            if pos in self.pending:
+                ids, data = self.pending[pos]
+                return ids.copy(), data.copy()
+            region = self.get_region(region_pos)
+        if region is None:
+            return None
+        # a write of the chunk finishing now replaces the index entry before
+        # the chunk leaves pending, so this reads the newest one either way
+        return region.read_chunk(local_pos)
+
+    def save_chunks(self, chunks):
+        'chunks: {pos: (ids, data)}, written before returning'
+        by_region = {}
+        for pos, chunk in chunks.items():
+            region_pos, local_pos = self.split_pos(pos)
+            by_region.setdefault(region_pos, {})[local_pos] = chunk
+
+        with self.write_lock:
+            for region_pos, region_chunks in by_region.items():
+                self.create_region(region_pos).write_chunks(region_chunks)
+
+    def save_chunks_async(self, chunks):
+        'chunks: {pos: (ids, data)}, the arrays must not be changed afterwards'
+        with self.lock:
+            self.pending.update(chunks)
+        self.queue.put(chunks)
+
+    def write_queued(self):
+        while True:
+            chunks = self.queue.get()
+            try:
+                self.save_chunks(chunks)
+            finally:
+                with self.lock:
+                    for pos, chunk in chunks.items():
+                        if self.pending.get(pos) is chunk:
+                            del self.pending[pos]
+                self.queue.task_done()
+
+    def flush(self):
+        'waits for queued writes'
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        with self.write_lock, self.lock:
+            for region in self.regions.values():
+                region.close()
+            self.regions = {}
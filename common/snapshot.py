@@ -0,0 +1,104 @@
+import struct
+from collections import OrderedDict
+
+# Players snapshot, all numbers are big endian.
+#
+# header: seq, base seq (0 = full snapshot), input seq (last position of the
+#         receiver the snapshot includes), updated, removed and names count
+# updated players: id, x, y
+# removed players: id
+# names of players the receiver does not know yet: id, name length, utf-8 name
+#
+# A snapshot state is a {player_id: (x, y)} dict, deltas are computed against
+# the last snapshot acknowledged by the receiver.
+
+HEADER = struct.Struct('!IIIHHH')
+PLAYER_RECORD = struct.Struct('!Iff')
+REMOVED_RECORD = struct.Struct('!I')
+NAME_HEADER = struct.Struct('!IB')
+
+# client -> server: last applied snapshot seq, input seq, x, y
+POSITION_RECORD = struct.Struct('!IIff')
+
+
+def quantize(pos):
+    'rounds a position the way it is sent, so that unchanged players compare equal'
+    return struct.unpack('!ff', struct.pack('!ff', pos[0], pos[1]))
+
+
+def encode_delta(seq, base_seq, base, state, names, input_seq=0):
+    if base is None:
+        base = {}
+
+    updated = [
+        (player_id, pos) for player_id, pos in state.items()
+        if base.get(player_id) != pos
+    ]
+    removed = [player_id for player_id in base if player_id not in state]
+    new_names = [
+        (player_id, names[player_id].encode()[:255]) for player_id in state
+        if player_id not in base
+    ]
+
+    parts = [HEADER.pack(seq, base_seq, input_seq, len(updated), len(removed), len(new_names))]
+    parts += [PLAYER_RECORD.pack(player_id, *pos) for player_id, pos in updated]
+    parts += [REMOVED_RECORD.pack(player_id) for player_id in removed]
+    for player_id, name in new_names:
+        parts.append(NAME_HEADER.pack(player_id, len(name)))
+        parts.append(name)
+
+    return b''.join(parts)
+
+
+def decode_delta(data):
+    'returns (seq, base_seq, updated {id: (x, y)}, removed [id], names {id: name}, input_seq)'
+    seq, base_seq, input_seq, updated_count, removed_count, names_count = HEADER.unpack_from(data, 0)
+    offset = HEADER.size
+
+    updated = {}
+    for _ in range(updated_count):
+        player_id, x, y = PLAYER_RECORD.unpack_from(data, offset)
+        updated[player_id] = (x, y)
+        offset += PLAYER_RECORD.size
+
+    removed = []
+    for _ in range(removed_count):
+        removed.append(REMOVED_RECORD.unpack_from(data, offset)[0])
+        offset += REMOVED_RECORD.size
+
+    names = {}
+    for _ in range(names_count):
+        player_id, length = NAME_HEADER.unpack_from(data, offset)
+        offset += NAME_HEADER.size
+        names[player_id] = bytes(data[offset:offset + length]).decode(errors='replace')
+        offset += length
+
+    return seq, base_seq, updated, removed, names, input_seq
+
+
+def apply_delta(base, updated, removed):
+    state = dict(base)
+    for player_id in removed:
+        state.pop(player_id, None)
+    state.update(updated)
+    return state
+
+
+class SnapshotHistory():
+    'last states by seq, both sides keep one to resolve delta bases'
+
+    def __init__(self, size=32) -> None:
+        self.size = size
+        self.states = OrderedDict()
+        self.last_seq = 0
+
+    def add(self, seq, state):
+        self.states[seq] = state
+        self.last_seq = max(self.last_seq, seq)
+        while len(self.states) > self.size:
+            self.states.popitem(last=False)
+
+    def get(self, seq):
+        if seq == 0:
+            return {}
+        return self.states.get(seq)
@@ -1,28 +1,24 @@
+import asyncio
 import socket
-import struct
-import zlib
-import math
 
-COMPRESSION_TRESHOLD = 1048576
+from common.framing import HEADER, encode_frame, decode_payload, send_frames, recv_frame, check_frame_size
 
 def sendall(s: socket.socket, data):
-    if len(data) > COMPRESSION_TRESHOLD:
-        data = zlib.compress(data)
-    msg_length = len(data)
-    # print(msg_length)
-    s.send(struct.pack('!i', msg_length))
-    s.send(data)
+    send_frames(s, [data])
 
 def recvall(s: socket.socket):
-    msg_length = s.recv(4)
-    if len(msg_length) == 0:
+    return recv_frame(s)
+
+async def recvall_async(reader: asyncio.StreamReader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+        msg_length, codec = HEADER.unpack(header)
+        check_frame_size(msg_length)
+        buf = await reader.readexactly(msg_length)
+    except asyncio.IncompleteReadError:
         return None
-    msg_length = struct.unpack('!i', msg_length)[0]
-    buf = b''
-    chunk_size = 2 ** max(16, int(math.log(msg_length, 2)))
-    while len(buf) < msg_length:
-        buf += s.recv(chunk_size)
-        # print(len(buf))
-    if msg_length > COMPRESSION_TRESHOLD:
-        return zlib.decompress(buf)
-    return buf
\ No newline at end of file
+    return decode_payload(codec, buf)
+
+async def sendall_async(writer: asyncio.StreamWriter, data):
+    writer.writelines(encode_frame(data))
+    await writer.drain()
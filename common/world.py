@@ -1,36 +1,98 @@
 from abc import abstractmethod
-import threading
+from collections import OrderedDict, deque
+import math
 import pygame
 import random
-import cloudpickle as pickle
 import numpy as np
 
-def generate_perlin_noise_2d(shape, res):
-    def f(t):
-        return 6*t**5 - 15*t**4 + 10*t**3
-
-    delta = (res[0] / shape[0], res[1] / shape[1])
-    d = (shape[0] // res[0], shape[1] // res[1])
-    grid = np.mgrid[0:res[0]:delta[0],0:res[1]:delta[1]].transpose(1, 2, 0) % 1
-    # Gradients
-    angles = 2*np.pi*np.random.rand(res[0]+1, res[1]+1)
-    gradients = np.dstack((np.cos(angles), np.sin(angles)))
-    g00 = gradients[0:-1,0:-1].repeat(d[0], 0).repeat(d[1], 1)
-    g10 = gradients[1:,0:-1].repeat(d[0], 0).repeat(d[1], 1)
-    g01 = gradients[0:-1,1:].repeat(d[0], 0).repeat(d[1], 1)
-    g11 = gradients[1:,1:].repeat(d[0], 0).repeat(d[1], 1)
-    # Ramps
-    n00 = np.sum(grid * g00, 2)
-    n10 = np.sum(np.dstack((grid[:,:,0]-1, grid[:,:,1])) * g10, 2)
-    n01 = np.sum(np.dstack((grid[:,:,0], grid[:,:,1]-1)) * g01, 2)
-    n11 = np.sum(np.dstack((grid[:,:,0]-1, grid[:,:,1]-1)) * g11, 2)
-    # Interpolation
-    t = f(grid)
-    n0 = n00*(1-t[:,:,0]) + t[:,:,0]*n10
-    n1 = n01*(1-t[:,:,0]) + t[:,:,0]*n11
-    return np.sqrt(2)*((1-t[:,:,1])*n0 + t[:,:,1]*n1)
+from common.world_format import encode_world, decode_world, FormatError
+from common.region import RegionStorage, is_world_dir
+from common.noise import fbm_noise_2d, hash_2d
+
+def generate_perlin_noise_2d(shape, res, octaves=1, seed=None):
+    'noise with res[0] x res[1] lattice cells over shape, shape does not have to be divisible by res'
+    if seed is None:
+        seed = random.getrandbits(63)
+    return fbm_noise_2d(seed, (0, 0), shape, (shape[0] / res[0], shape[1] / res[1]), octaves)
+
+WATER_TRASHOLDS = (-0.6, -0.35, -0.2)
+SAND_TRASHOLDS = (0.0,)
+TERRAIN_TRASHOLDS = (0.2, 0.35, 0.55, 0.85)
+# shining blocks are placed by a hash unrelated to the noise gradients
+SHINING_BLOCK_SALT = 0x5DEECE66D
+
+def classify_height_map(noise):
+    # water below -0.1, sand below 0.1, terrain above
+    kind = np.digitize(noise, (-0.1, 0.1))
+    ids = np.array((2, 3, 4), dtype=np.uint8)[kind]
+
+    # right=True counts trasholds strictly lower than the height
+    deepness = 3 - np.digitize(noise, WATER_TRASHOLDS, right=True)
+    sand_height = np.digitize(noise, SAND_TRASHOLDS, right=True)
+    terrain_height = np.digitize(noise, TERRAIN_TRASHOLDS, right=True)
+    data = np.choose(kind, (deepness, sand_height, terrain_height)).astype(np.uint8)
+
+    return ids, data
+
+class ChunkGenerator():
+    'Generates any chunk on its own from the seed, the same chunk every time'
+
+    def __init__(self, seed, chunk_size, period=32, octaves=3, persistence=0.5, lacunarity=2.) -> None:
+        # stored as uint64 in world.info
+        self.seed = seed & 0xFFFFFFFFFFFFFFFF
+        self.chunk_size = chunk_size
+        # blocks between noise lattice points of the first octave
+        self.period = period
+        self.octaves = octaves
+        self.persistence = persistence
+        self.lacunarity = lacunarity
+
+    def generate_chunk(self, pos):
+        'returns (ids, data) of the chunk at pos'
+        noise = fbm_noise_2d(
+            self.seed,
+            (pos[0] * self.chunk_size, pos[1] * self.chunk_size),
+            (self.chunk_size, self.chunk_size),
+            self.period,
+            self.octaves,
+            self.persistence,
+            self.lacunarity
+        )
+        ids, data = classify_height_map(noise)
+
+        # not hash(), it may change between python versions and chunks that were
+        # never changed are generated again every time they are loaded
+        rng = random.Random(int(hash_2d(self.seed ^ SHINING_BLOCK_SALT, pos[0], pos[1])))
+        if rng.randint(0, 10) <= 10:
+            x = rng.randint(0, self.chunk_size - 1)
+            y = rng.randint(0, self.chunk_size - 1)
+            ids[x, y] = 255
+            data[x, y] = 0
+
+        return ids, data
 
 class World():
+    class Chunk():
+        # ids index into World.id_dict (the block palette), data is the
+        # per-block parameter of that block class (color index, deepnes, height...)
+        def __init__(self, size, ids=None, data=None) -> None:
+            if ids is None:
+                ids = np.zeros((size, size), dtype=np.uint8)
+            if data is None:
+                data = np.zeros((size, size), dtype=np.uint8)
+            self.ids = ids
+            self.data = data
+            # float32 speed multiplier of every block, made by World.get_chunk_speeds
+            self.speeds = None
+            # World.set_block changes as (version, block_x, block_y, id, data), oldest first,
+            # journal_base is the version before the oldest one
+            self.version = 0
+            self.journal = deque()
+            self.journal_base = 0
+            # version at the server that saves the chunk, for copies made by
+            # World.replace_blocks, None when it was read from disk
+            self.source_version = None
+
     class BaseBlock():
         def __init__(self, pos, data=None) -> None:
             # pos = (chunk_x, chunk_y, x, y)
@@ -54,33 +116,37 @@ class World():
             return f'{self.__class__}({self.pos}, data={self.data})'
 
     class SimpleBlock(BaseBlock):
-        # data = color
+        # data = index in colors
+        colors = tuple(
+            (r * 51, g * 51, b * 51) for r in range(6) for g in range(6) for b in range(6)
+        )
+
         def render(self, canvas, offset, chunk_size):
             dx, dy = offset
             px = self.pos[0] * 64 * chunk_size + self.pos[2] * 64 + dx
             py = self.pos[1] * 64 * chunk_size + self.pos[3] * 64 + dy
 
-            pygame.draw.rect(canvas, self.data, (px, py, 64, 64))
+            pygame.draw.rect(canvas, self.colors[self.data], (px, py, 64, 64))
         
         def get_id(self):
             return 1
 
     class Water(BaseBlock):
         'data: deepnes'
-        def __init__(self, pos, data=None) -> None:
-            super().__init__(pos, data=data)
+        colors = (
+            (142, 215, 248),
+            (72, 176, 223),
+            (6, 141, 206),
+            (0, 74, 135)
+        )
 
-            colors = (
-                (142, 215, 248),
-                (72, 176, 223),
-                (6, 141, 206),
-                (0, 74, 135)
-            )
+        speed_multipliers = (0.7, 0.5, 0.3, 0.1)
 
-            speed_multipliers = (0.7, 0.5, 0.3, 0.1)
+        def __init__(self, pos, data=None) -> None:
+            super().__init__(pos, data=data)
 
-            self.color = colors[data]
-            self.speed_multiplier = speed_multipliers[data]
+            self.color = self.colors[data]
+            self.speed_multiplier = self.speed_multipliers[data]
 
         def render(self, canvas, offset, chunk_size):
             dx, dy = offset
@@ -97,18 +163,18 @@ class World():
 
     class Sand(BaseBlock):
         'data: height'
-        def __init__(self, pos, data=None) -> None:
-            super().__init__(pos, data=data)
+        colors = (
+            (248, 248, 223),
+            (238, 236, 204)
+        )
 
-            colors = (
-                (248, 248, 223),
-                (238, 236, 204)
-            )
+        speed_multipliers = (0.8, 0.9)
 
-            speed_multipliers = (0.8, 0.9)
+        def __init__(self, pos, data=None) -> None:
+            super().__init__(pos, data=data)
 
-            self.color = colors[data]
-            self.speed_multiplier = speed_multipliers[data]
+            self.color = self.colors[data]
+            self.speed_multiplier = self.speed_multipliers[data]
 
         def render(self, canvas, offset, chunk_size):
             dx, dy = offset
@@ -125,18 +191,18 @@ class World():
 
     class Terrain(BaseBlock):
         'data: height'
+        colors = (
+            (163, 209, 45),
+            (124, 184, 51),
+            (86, 159, 57),
+            (47, 134, 62),
+            (8, 109, 68)
+        )
+
         def __init__(self, pos, data=None) -> None:
             super().__init__(pos, data=data)
 
-            colors = (
-                (163, 209, 45),
-                (124, 184, 51),
-                (86, 159, 57),
-                (47, 134, 62),
-                (8, 109, 68)
-            )
-
-            self.color = colors[data]
+            self.color = self.colors[data]
 
         def render(self, canvas, offset, chunk_size):
             dx, dy = offset
@@ -171,13 +237,14 @@ class World():
                 (255, 255, 255)
             )
 
-            random.seed(dx * 64 + dy)
+            # same pattern every time the block is drawn
+            rng = random.Random(hash(self.pos))
 
             for i in range(32):
                 for j in range(32):
                     pygame.draw.rect(
                         canvas,
-                        colors[random.randint(0, len(colors) - 1)],
+                        colors[rng.randint(0, len(colors) - 1)],
                         (px + i * 2, py + j * 2, 2, 2)
                     )
 
@@ -187,82 +254,306 @@ class World():
     def generate_random_wolrd(self):
         for i in range(self.chunks_count[0]):
             for j in range(self.chunks_count[1]):
-                self.chunks[i][j] = [[None] * self.CHUNK_SIZE for k in range(self.CHUNK_SIZE)]
+                chunk = World.Chunk(self.CHUNK_SIZE)
+                chunk.ids[:, :] = 1
+                chunk.data[:, :] = np.random.randint(
+                    0, len(World.SimpleBlock.colors), (self.CHUNK_SIZE, self.CHUNK_SIZE)
+                )
+                self.chunks[(i, j)] = chunk
+        self.dirty_chunks.update(self.chunks.keys())
 
-        for i in range(self.chunks_count[0]):
-            for j in range(self.chunks_count[1]):
-                for n in range(self.CHUNK_SIZE):
-                    for m in range(self.CHUNK_SIZE):
-                        self.chunks[i][j][n][m] = World.SimpleBlock(
-                            (i, j, n, m), 
-                            (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-                        )
-    
     def generate_world_from_perlin_noise(self):
-        for i in range(self.chunks_count[0]):
-            for j in range(self.chunks_count[1]):
-                self.chunks[i][j] = [[None] * self.CHUNK_SIZE for k in range(self.CHUNK_SIZE)]
-
         noise = generate_perlin_noise_2d(
             (self.chunks_count[0] * self.CHUNK_SIZE, self.chunks_count[1] * self.CHUNK_SIZE),
-            (self.chunks_count[0] * self.CHUNK_SIZE // 32, self.chunks_count[1] * self.CHUNK_SIZE // 32)
+            (self.chunks_count[0] * self.CHUNK_SIZE // 32, self.chunks_count[1] * self.CHUNK_SIZE // 32),
+            octaves=3
         )
 
-        def paint_chunk_from_noise(i, j):
-            for n in range(self.CHUNK_SIZE):
-                for m in range(self.CHUNK_SIZE):
-                    h = noise[i * self.CHUNK_SIZE + n, j * self.CHUNK_SIZE + m]
-                    if h < -0.1: # water
-                        trasholds = (-0.6, -0.35, -0.2)
-                        deepness = 3
-                        for trashold in trasholds:
-                            if h > trashold: deepness -= 1
-                        block = World.Water((i, j, n, m), deepness)
-                    elif h < 0.1: # sand
-                        trasholds = (0.0,)
-                        height = 0
-                        for trashold in trasholds:
-                            if h > trashold: height += 1
-                        block = World.Sand((i, j, n, m), height)
-                    else: # terrain
-                        trasholds = (0.2, 0.35, 0.55, 0.85)
-                        height = 0
-                        for trashold in trasholds:
-                            if h > trashold: height += 1
-                        block = World.Terrain((i, j, n, m), height)
-
-                    self.chunks[i][j][n][m] = block
+        ids, data = classify_height_map(noise)
+
+        # (x, y) -> (chunk_x, chunk_y, block_x, block_y)
+        shape = (self.chunks_count[0], self.CHUNK_SIZE, self.chunks_count[1], self.CHUNK_SIZE)
+        ids = ids.reshape(shape).transpose(0, 2, 1, 3)
+        data = data.reshape(shape).transpose(0, 2, 1, 3)
 
         for i in range(self.chunks_count[0]):
             for j in range(self.chunks_count[1]):
-                paint_chunk_from_noise(i, j)
+                self.chunks[(i, j)] = World.Chunk(
+                    self.CHUNK_SIZE,
+                    np.ascontiguousarray(ids[i, j]),
+                    np.ascontiguousarray(data[i, j])
+                )
 
         for i in range(self.chunks_count[0]):
             for j in range(self.chunks_count[1]):
                 if random.randint(0, 10) <= 10:
                     x = random.randint(0, self.CHUNK_SIZE - 1)
                     y = random.randint(0, self.CHUNK_SIZE - 1)
-                    self.chunks[i][j][x][y] = World.ShiningBlock(
-                        (i, j, x, y)
-                    )
-
-    # def get_new_block_buy_id(self, id, pos, data=None):
-    #     return self.id_dict[id]
+                    self.chunks[(i, j)].ids[x, y] = 255
+                    self.chunks[(i, j)].data[x, y] = 0
+
+        self.dirty_chunks.update(self.chunks.keys())
+
+    def get_chunk(self, pos):
+        'loaded chunk, or the saved or generated one loaded now, or None'
+        chunk = self.chunks.get(pos)
+        if chunk is not None or not self.is_chunk_in_world(pos):
+            return chunk
+
+        stored = None
+        if self.storage is not None:
+            stored = self.storage.load_chunk(pos)
+        # generated chunks are not dirty, they can be generated again
+        if stored is None and self.generator is not None:
+            stored = self.generator.generate_chunk(pos)
+
+        if stored is not None:
+            chunk = World.Chunk(self.CHUNK_SIZE, *stored)
+            self.add_chunk(pos, chunk)
+        return chunk
+
+    def generate_chunks(self, positions, pool=None):
+        '''
+        loads or generates all missing chunks of positions at once,
+        generation runs in the worker processes of pool (a ChunkPool) when given
+        '''
+        if pool is None or self.generator is None:
+            for pos in positions:
+                self.get_chunk(pos)
+            return
+
+        missing = []
+        for pos in positions:
+            if pos in self.chunks or not self.is_chunk_in_world(pos):
+                continue
+            stored = self.storage.load_chunk(pos) if self.storage is not None else None
+            if stored is not None:
+                self.add_chunk(pos, World.Chunk(self.CHUNK_SIZE, *stored))
+            else:
+                missing.append(pos)
+
+        for batch_positions, ids, data in pool.generate(self.generator, missing):
+            for i, pos in enumerate(batch_positions):
+                self.add_chunk(pos, World.Chunk(self.CHUNK_SIZE, ids[i], data[i]))
+
+    def get_block(self, chunk_x, chunk_y, block_x, block_y) -> BaseBlock:
+        # blocks are not stored as objects, a view is built on every call
+        chunk = self.get_chunk((chunk_x, chunk_y))
+        if chunk is None: return None
+
+        return self.id_dict[int(chunk.ids[block_x, block_y])](
+            (chunk_x, chunk_y, block_x, block_y),
+            int(chunk.data[block_x, block_y])
+        )
 
     def get_block_by_pos(self, pos) -> BaseBlock:
-        if pos[0] < 0 or pos[1] < 0: return None
-        if pos[0] > self.chunks_count[0] * self.CHUNK_SIZE * 64: return None
-        if pos[1] > self.chunks_count[1] * self.CHUNK_SIZE * 64: return None
+        chunk_x, chunk_y = self.get_chunk_pos(pos)
+        if not self.is_chunk_in_world((chunk_x, chunk_y)): return None
 
-        chunk_x = int(pos[0]) // 64 // self.CHUNK_SIZE
-        block_x = (int(pos[0]) - chunk_x * self.CHUNK_SIZE * 64) // 64
+        block_x = (math.floor(pos[0]) - chunk_x * self.CHUNK_SIZE * 64) // 64
+        block_y = (math.floor(pos[1]) - chunk_y * self.CHUNK_SIZE * 64) // 64
 
-        chunk_y = int(pos[1]) // 64 // self.CHUNK_SIZE
-        block_y = (int(pos[1]) - chunk_y * self.CHUNK_SIZE * 64) // 64
+        return self.get_block(chunk_x, chunk_y, block_x, block_y)
 
-        return self.chunks[chunk_x][chunk_y][block_x][block_y]
+    def get_chunk_pos(self, pos):
+        return (math.floor(pos[0]) // 64 // self.CHUNK_SIZE, math.floor(pos[1]) // 64 // self.CHUNK_SIZE)
 
-    def __init__(self, chunks_count=(0, 0)):
+    def is_valid_block(self, block_id, data):
+        'blocks that can be placed: a known id and data inside its palette'
+        block_class = self.id_dict.get(block_id)
+        if block_class is None or block_class is World.BaseBlock:
+            return False
+        colors = getattr(block_class, 'colors', None)
+        if colors is None:
+            return data == 0
+        return 0 <= data < len(colors)
+
+    def write_blocks(self, pos, changes):
+        'writes [(block_x, block_y, id, data)] to the loaded chunk at pos without recording them'
+        chunk = self.chunks[pos]
+        # chunks decoded from received bytes are read-only views into them
+        if not chunk.ids.flags.writeable:
+            chunk.ids = chunk.ids.copy()
+        if not chunk.data.flags.writeable:
+            chunk.data = chunk.data.copy()
+
+        for block_x, block_y, block_id, data in changes:
+            chunk.ids[block_x, block_y] = block_id
+            chunk.data[block_x, block_y] = data
+        chunk.speeds = None
+        self.invalidate_chunk_surface(pos)
+
+    def set_block(self, chunk_x, chunk_y, block_x, block_y, block_id, data=0):
+        '''
+        changes one block and records it in the journal of its chunk,
+        returns False if there is no chunk or the block is like that already
+        '''
+        pos = (chunk_x, chunk_y)
+        chunk = self.get_chunk(pos)
+        if chunk is None:
+            return False
+        if chunk.ids[block_x, block_y] == block_id and chunk.data[block_x, block_y] == data:
+            return False
+        self.record_block(pos, block_x, block_y, block_id, data)
+        self.dirty_chunks.add(pos)
+        return True
+
+    def record_block(self, pos, block_x, block_y, block_id, data):
+        'writes one block of the loaded chunk at pos and records it in the journal'
+        self.write_blocks(pos, [(block_x, block_y, block_id, data)])
+
+        # one counter for all chunks, a chunk loaded again never reuses a version
+        chunk = self.chunks[pos]
+        self.last_version += 1
+        chunk.version = self.last_version
+        chunk.journal.append((chunk.version, block_x, block_y, block_id, data))
+        if len(chunk.journal) > self.journal_size:
+            chunk.journal_base = chunk.journal.popleft()[0]
+        self.changed_chunks.add(pos)
+
+    def replace_blocks(self, pos, ids, data, source_version=None):
+        '''
+        makes the chunk at pos equal to ids and data, the changed blocks are
+        recorded like set_block changes, but the chunk is not saved, for
+        chunks saved by another server that has them at source_version
+        '''
+        chunk = self.chunks.get(pos)
+        if chunk is None:
+            chunk = World.Chunk(self.CHUNK_SIZE, ids, data)
+            self.add_chunk(pos, chunk)
+            # a new version without journal, whoever had the chunk gets it whole
+            self.last_version += 1
+            chunk.version = chunk.journal_base = self.last_version
+            self.changed_chunks.add(pos)
+        else:
+            for block_x, block_y in np.argwhere((chunk.ids != ids) | (chunk.data != data)):
+                block_x, block_y = int(block_x), int(block_y)
+                self.record_block(pos, block_x, block_y, int(ids[block_x, block_y]), int(data[block_x, block_y]))
+        chunk.source_version = source_version
+
+    def set_block_by_pos(self, pos, block_id, data=0):
+        block_x, block_y = math.floor(pos[0]) // 64, math.floor(pos[1]) // 64
+        return self.set_block(
+            block_x // self.CHUNK_SIZE, block_y // self.CHUNK_SIZE,
+            block_x % self.CHUNK_SIZE, block_y % self.CHUNK_SIZE,
+            block_id, data
+        )
+
+    def get_changes(self, pos, version):
+        '''
+        changes of the loaded chunk at pos made after version, the last one of
+        every block, None if the journal does not go back to version and the
+        whole chunk has to be sent
+        '''
+        chunk = self.chunks.get(pos)
+        if chunk is None or version is None:
+            return None
+        if version == chunk.version:
+            return []
+        if version != chunk.journal_base and all(entry[0] != version for entry in chunk.journal):
+            return None
+
+        changes = {}
+        for entry_version, block_x, block_y, block_id, data in chunk.journal:
+            if entry_version > version:
+                changes[(block_x, block_y)] = (block_x, block_y, block_id, data)
+        return list(changes.values())
+
+    def take_changed_chunks(self):
+        'positions of chunks changed by set_block since the last call'
+        changed, self.changed_chunks = self.changed_chunks, set()
+        return changed
+
+    def get_chunk_speeds(self, pos):
+        'speed multipliers of the blocks of the chunk at pos, None if there is no chunk'
+        chunk = self.get_chunk(pos)
+        if chunk is None:
+            return None
+        if chunk.speeds is None:
+            chunk.speeds = self.speed_table[chunk.ids, chunk.data]
+        return chunk.speeds
+
+    def get_speed_multiplier(self, pos):
+        'get_block_by_pos(pos).get_speed_multiplier() without making the block, None if there is no chunk'
+        block_x, block_y = math.floor(pos[0]) // 64, math.floor(pos[1]) // 64
+        speeds = self.get_chunk_speeds((block_x // self.CHUNK_SIZE, block_y // self.CHUNK_SIZE))
+        if speeds is None:
+            return None
+        return float(speeds[block_x % self.CHUNK_SIZE, block_y % self.CHUNK_SIZE])
+
+    def get_speed_multipliers(self, positions, default=0.):
+        '''
+        speed multipliers at many positions at once, an (n, 2) array of pixels,
+        default where there is no chunk
+        '''
+        blocks = np.floor_divide(np.asarray(positions, dtype=np.float64), 64).astype(np.int64)
+        return self.get_block_speeds(blocks, default)
+
+    def get_block_speeds(self, blocks, default=0.):
+        'speed multipliers of an (n, 2) array of world block coordinates'
+        blocks = np.asarray(blocks, dtype=np.int64).reshape(-1, 2)
+        chunks = blocks // self.CHUNK_SIZE
+        local = blocks % self.CHUNK_SIZE
+        # one int64 per chunk, np.unique over rows is much slower
+        keys = (chunks[:, 0] << 32) | (chunks[:, 1] & 0xFFFFFFFF)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+        # one grid per chunk the blocks are in
+        grids = np.empty((len(first), self.CHUNK_SIZE, self.CHUNK_SIZE), dtype=np.float32)
+        for i, chunk_pos in enumerate(chunks[first].tolist()):
+            speeds = self.get_chunk_speeds(tuple(chunk_pos))
+            grids[i] = speeds if speeds is not None else default
+        return grids[inverse.reshape(-1), local[:, 0], local[:, 1]]
+
+    def is_infinite(self):
+        return self.chunks_count is None
+
+    def is_chunk_in_world(self, chunk_pos):
+        if self.is_infinite():
+            return True
+        return 0 <= chunk_pos[0] < self.chunks_count[0] and 0 <= chunk_pos[1] < self.chunks_count[1]
+
+    def get_chunks_around(self, chunk_pos, radius):
+        'chunk positions in the square of given radius, nearest first'
+        positions = [
+            (chunk_pos[0] + i, chunk_pos[1] + j)
+            for i in range(-radius, radius + 1)
+            for j in range(-radius, radius + 1)
+        ]
+        positions = [pos for pos in positions if self.is_chunk_in_world(pos)]
+        positions.sort(key=lambda pos: (pos[0] - chunk_pos[0]) ** 2 + (pos[1] - chunk_pos[1]) ** 2)
+        return positions
+
+    def add_chunk(self, pos, chunk):
+        self.chunks[pos] = chunk
+        self.chunks.move_to_end(pos)
+        self.invalidate_chunk_surface(pos)
+
+        if self.max_loaded_chunks is not None:
+            while len(self.chunks) > self.max_loaded_chunks:
+                # unsaved chunks stay loaded
+                clean_pos = next((pos for pos in self.chunks if pos not in self.dirty_chunks), None)
+                if clean_pos is None:
+                    break
+                self.remove_chunk(clean_pos)
+
+    def remove_chunk(self, pos):
+        self.chunks.pop(pos, None)
+        self.invalidate_chunk_surface(pos)
+
+    def unload_far_chunks(self, chunk_pos, radius):
+        far_chunks = [
+            pos for pos in self.chunks
+            if max(abs(pos[0] - chunk_pos[0]), abs(pos[1] - chunk_pos[1])) > radius
+        ]
+        for pos in far_chunks:
+            self.remove_chunk(pos)
+
+    def __init__(self, chunks_count=(0, 0), max_loaded_chunks=None, generator=None):
+        '''
+        chunks_count=None makes an infinite world, its chunks are made by the
+        generator (a ChunkGenerator) when they are first used
+        '''
         
         self.id_dict = {
             0: World.BaseBlock,
@@ -275,69 +566,280 @@ class World():
 
         self.CHUNK_SIZE = 32
         self.chunks_count = chunks_count
-        self.chunks = [[None] * chunks_count[0] for i in range(chunks_count[1])]
+        # (chunk_x, chunk_y) -> World.Chunk, least recently used first
+        self.chunks = OrderedDict()
+        self.max_loaded_chunks = max_loaded_chunks
+
+        # region files the world is saved to, chunks missing in self.chunks are read from it
+        self.storage = None
+        self.generator = generator
+        # positions of chunks changed since the last save
+        self.dirty_chunks = set()
+        # positions of chunks changed since the last take_changed_chunks
+        self.changed_chunks = set()
+        # last version given to a chunk by set_block
+        self.last_version = 0
+        # changes kept per chunk, clients further behind get the whole chunk
+        self.journal_size = 256
+
+        # (chunk_x, chunk_y) -> pre-rendered pygame.Surface of the chunk, 16 MiB each
+        self.chunk_surfaces = {}
+        # surfaces of chunks this many pixels around the visible area are made
+        # ahead, chunk_surface_rows rows of blocks per frame, so chunks coming
+        # into view do not stop a frame for the whole surface
+        self.chunk_surfaces_margin = 256
+        # the 3x2 chunks around a 1920x1080 screen with the margin, more are
+        # kept only when more are around the visible area
+        self.max_chunk_surfaces = 6
+        self.chunk_surface_rows = 8
+        # (chunk_pos, surface, rows done) of the surface being made ahead
+        self.chunk_surface_build = None
+        # the last dropped surface, the next one is drawn over it
+        self.spare_chunk_surface = None
+
+        # [id, data] -> color of blocks that are a plain square
+        self.color_table = np.zeros((256, 256, 3), dtype=np.uint8)
+        for block_id, block_class in self.id_dict.items():
+            for data, color in enumerate(getattr(block_class, 'colors', ())):
+                self.color_table[block_id, data] = color
+
+        # [id, data] -> speed multiplier, 1 for blocks without speed_multipliers
+        self.speed_table = np.ones((256, 256), dtype=np.float32)
+        for block_id, block_class in self.id_dict.items():
+            for data, multiplier in enumerate(getattr(block_class, 'speed_multipliers', ())):
+                self.speed_table[block_id, data] = multiplier
 
     def is_rectangles_overlap(self, R1, R2):
         if (R1[0]>=R2[2]) or (R1[2]<=R2[0]) or (R1[3]<=R2[1]) or (R1[1]>=R2[3]):
             return False
         return True
 
-    def render(self, canvas, offset, visible_area):
-        for i, chunk_row in enumerate(self.chunks):
-            for j, chunk in enumerate(chunk_row):
-                chunk_area = (
-                    i * 64 * self.CHUNK_SIZE,
-                    j * 64 * self.CHUNK_SIZE,
-                    (i + 1) * 64 * self.CHUNK_SIZE,
-                    (j + 1) * 64 * self.CHUNK_SIZE
-                )
-
-                if self.is_rectangles_overlap(chunk_area, visible_area):
-                    for row in chunk:
-                        for block in row:
-                            block.render(canvas, offset, self.CHUNK_SIZE)
+    def get_cells_range(self, area, cell_size, limit):
+        'indexes of cells of cell_size overlapping area, clipped to [0, limit) unless limit is None'
+        if limit is None:
+            return (
+                range(math.floor(area[0] / cell_size), math.ceil(area[2] / cell_size)),
+                range(math.floor(area[1] / cell_size), math.ceil(area[3] / cell_size))
+            )
+        return (
+            range(max(0, math.floor(area[0] / cell_size)), min(limit[0], math.ceil(area[2] / cell_size))),
+            range(max(0, math.floor(area[1] / cell_size)), min(limit[1], math.ceil(area[3] / cell_size)))
+        )
 
-    def save(self):
-        pass
+    def get_visible_chunks(self, visible_area):
+        'positions of loaded chunks overlapping visible_area'
+        range_x, range_y = self.get_cells_range(visible_area, 64 * self.CHUNK_SIZE, self.chunks_count)
+        return [(i, j) for i in range_x for j in range_y if (i, j) in self.chunks]
+
+    def get_visible_blocks(self, visible_area):
+        'yields (chunk_pos, range_x, range_y) of the blocks overlapping visible_area'
+        for i, j in self.get_visible_chunks(visible_area):
+            chunk_x, chunk_y = i * 64 * self.CHUNK_SIZE, j * 64 * self.CHUNK_SIZE
+            range_x, range_y = self.get_cells_range(
+                (
+                    visible_area[0] - chunk_x,
+                    visible_area[1] - chunk_y,
+                    visible_area[2] - chunk_x,
+                    visible_area[3] - chunk_y
+                ),
+                64,
+                (self.CHUNK_SIZE, self.CHUNK_SIZE)
+            )
+            yield (i, j), range_x, range_y
 
-    def load(self):
-        pass
+    def render(self, canvas, offset, visible_area):
+        visible_chunks = self.get_visible_chunks(visible_area)
+        for i, j in visible_chunks:
+            self.chunks.move_to_end((i, j))
+            canvas.blit(
+                self.get_chunk_surface((i, j)),
+                (i * 64 * self.CHUNK_SIZE + offset[0], j * 64 * self.CHUNK_SIZE + offset[1])
+            )
 
-    def to_binary(self):
-        binary_chanks = [[None] * self.chunks_count[0] for i in range(self.chunks_count[1])]
-        for i in range(self.chunks_count[0]):
-            for j in range(self.chunks_count[1]):
-                binary_chanks[i][j] = [[None] * self.CHUNK_SIZE for k in range(self.CHUNK_SIZE)]
+        margin = self.chunk_surfaces_margin
+        nearby_chunks = self.get_visible_chunks((
+            visible_area[0] - margin, visible_area[1] - margin,
+            visible_area[2] + margin, visible_area[3] + margin
+        ))
+        chunk_pos = self.get_chunk_pos((
+            (visible_area[0] + visible_area[2]) / 2,
+            (visible_area[1] + visible_area[3]) / 2
+        ))
+        self.build_chunk_surfaces(chunk_pos, nearby_chunks)
+        self.evict_chunk_surfaces(chunk_pos, nearby_chunks)
+
+    def render_blocks(self, canvas, offset, visible_area):
+        'draws visible blocks one by one, without the chunk surfaces cache'
+        for (i, j), range_x, range_y in self.get_visible_blocks(visible_area):
+            for n in range_x:
+                for m in range_y:
+                    self.get_block(i, j, n, m).render(canvas, offset, self.CHUNK_SIZE)
+
+    def new_chunk_surface(self):
+        # allocating 16 MiB takes longer than drawing a few rows on it
+        if self.spare_chunk_surface is not None:
+            surface, self.spare_chunk_surface = self.spare_chunk_surface, None
+            return surface
+
+        size = (self.CHUNK_SIZE * 64, self.CHUNK_SIZE * 64)
+        display = pygame.display.get_surface()
+        if display is None:
+            return pygame.Surface(size)
+        # blits of surfaces in the display format do not convert every pixel,
+        # made in it rather than convert()ed, that copies all 16 MiB
+        return pygame.Surface(size, 0, display)
+
+    def render_chunk_rows(self, surface, pos, start, end):
+        'draws the rows of blocks from start to end of the chunk at pos on its surface'
+        chunk = self.chunks[pos]
+
+        # one pixel per block, then scaled up to 64x64 squares
+        colors = self.color_table[chunk.ids[:, start:end], chunk.data[:, start:end]]
+        pygame.transform.scale(
+            pygame.surfarray.make_surface(colors),
+            (self.CHUNK_SIZE * 64, (end - start) * 64),
+            surface.subsurface((0, start * 64, self.CHUNK_SIZE * 64, (end - start) * 64))
+        )
 
-        for i in range(self.chunks_count[0]):
-            for j in range(self.chunks_count[1]):
-                for n in range(self.CHUNK_SIZE):
-                    for m in range(self.CHUNK_SIZE):
-                        binary_chanks[i][j][n][m] = self.chunks[i][j][n][m].get_data()
+        # blocks that are more than a square draw themselves on top
+        chunk_offset = (-pos[0] * 64 * self.CHUNK_SIZE, -pos[1] * 64 * self.CHUNK_SIZE)
+        for block_id, block_class in self.id_dict.items():
+            if hasattr(block_class, 'colors') or block_class is World.BaseBlock:
+                continue
+            for n, m in zip(*np.nonzero(chunk.ids[:, start:end] == block_id)):
+                self.get_block(pos[0], pos[1], int(n), start + int(m)).render(surface, chunk_offset, self.CHUNK_SIZE)
+
+    def render_chunk_surface(self, pos):
+        surface = self.new_chunk_surface()
+        self.render_chunk_rows(surface, pos, 0, self.CHUNK_SIZE)
+        return surface
+
+    def get_chunk_surface(self, pos):
+        surface = self.chunk_surfaces.get(pos)
+        if surface is None:
+            surface = self.render_chunk_surface(pos)
+            self.chunk_surfaces[pos] = surface
+        return surface
+
+    def build_chunk_surfaces(self, chunk_pos, nearby_chunks):
+        'makes chunk_surface_rows rows of the surface of one of nearby_chunks that has none'
+        if self.chunk_surface_build is None:
+            missing = [pos for pos in nearby_chunks if pos not in self.chunk_surfaces]
+            if not missing:
+                return
+            # the surface dropped to make room is drawn over
+            self.evict_chunk_surfaces(chunk_pos, nearby_chunks, reserved=1)
+            self.chunk_surface_build = (missing[0], self.new_chunk_surface(), 0)
+
+        pos, surface, start = self.chunk_surface_build
+        if pos not in self.chunks or pos in self.chunk_surfaces:
+            # unloaded, changed or made whole since
+            self.chunk_surface_build = None
+            return
+        end = min(start + self.chunk_surface_rows, self.CHUNK_SIZE)
+        self.render_chunk_rows(surface, pos, start, end)
+        if end < self.CHUNK_SIZE:
+            self.chunk_surface_build = (pos, surface, end)
+        else:
+            self.chunk_surfaces[pos] = surface
+            self.chunk_surface_build = None
+
+    def invalidate_chunk_surface(self, pos):
+        self.chunk_surfaces.pop(pos, None)
+        if self.chunk_surface_build is not None and self.chunk_surface_build[0] == pos:
+            self.chunk_surface_build = None
+
+    def evict_chunk_surfaces(self, chunk_pos, nearby_chunks=(), reserved=0):
+        '''
+        drops the surfaces furthest from chunk_pos above max_chunk_surfaces
+        minus reserved, the nearby ones last
+        '''
+        nearby_chunks = set(nearby_chunks)
+
+        def distance(pos):
+            return (pos not in nearby_chunks, max(abs(pos[0] - chunk_pos[0]), abs(pos[1] - chunk_pos[1])))
+
+        max_surfaces = max(self.max_chunk_surfaces, len(nearby_chunks)) - reserved
+        by_distance = sorted(self.chunk_surfaces, key=distance, reverse=True)
+        for pos in by_distance[:max(0, len(by_distance) - max_surfaces)]:
+            self.spare_chunk_surface = self.chunk_surfaces.pop(pos)
+
+    @staticmethod
+    def is_saved(path):
+        return is_world_dir(path)
+
+    def save(self, path=None, wait=False):
+        '''
+        Writes chunks changed since the last save in the background,
+        with wait=True returns when they are on disk
+        '''
+        if self.storage is None:
+            self.storage = RegionStorage(path, self.CHUNK_SIZE)
+            seed = self.generator.seed if self.generator is not None else None
+            self.storage.save_meta(self.chunks_count, seed)
+
+        chunks = dict(
+            (pos, (self.chunks[pos].ids.copy(), self.chunks[pos].data.copy()))
+            for pos in self.dirty_chunks if pos in self.chunks
+        )
+        self.dirty_chunks = set()
+        self.storage.save_chunks_async(chunks)
+
+        if wait:
+            self.storage.flush()
+
+    def load(self, path):
+        'opens a saved world, chunks are read when they are first used'
+        if self.storage is not None:
+            self.storage.close()
+        self.storage = RegionStorage(path, self.CHUNK_SIZE)
+        self.chunks_count, seed = self.storage.load_meta()
+        if seed is not None:
+            self.generator = ChunkGenerator(seed, self.CHUNK_SIZE)
+
+        self.chunks = OrderedDict()
+        self.chunk_surfaces = {}
+        self.chunk_surface_build = None
+        self.dirty_chunks = set()
+        self.changed_chunks = set()
+
+    def to_binary(self, positions=None, compress=True):
+        if positions is None:
+            positions = list(self.chunks.keys())
+
+        chunks = [(pos, self.get_chunk(pos)) for pos in positions]
+        return encode_world(
+            self.CHUNK_SIZE,
+            self.chunks_count,
+            ((pos, chunk.ids, chunk.data) for pos, chunk in chunks if chunk is not None),
+            compress
+        )
 
-        return pickle.dumps((self.chunks_count, binary_chanks))
+    def load_chunks_from_binary(self, data, pool=None):
+        '''
+        adds chunks from data to the loaded ones, returns their positions
+        chunks are decoded in the worker processes of pool (a ChunkPool) when given
+        '''
+        if pool is None:
+            chunk_size, self.chunks_count, binary_chunks = decode_world(data)
+        else:
+            chunk_size, self.chunks_count, batches = pool.decode(data)
+            binary_chunks = (
+                (pos, ids[i], data[i])
+                for positions, ids, data in batches
+                for i, pos in enumerate(positions)
+            )
+        if chunk_size != self.CHUNK_SIZE:
+            raise FormatError(f'chunk size {chunk_size} != {self.CHUNK_SIZE}')
+
+        positions = []
+        for pos, ids, data in binary_chunks:
+            self.add_chunk(pos, World.Chunk(self.CHUNK_SIZE, ids, data))
+            positions.append(pos)
+        return positions
     
-    def from_binary(self, data):
-        self.chunks_count, binary_chunks = pickle.loads(data)
-        print(self.chunks_count)
-
-        self.chunks = [[None] * self.chunks_count[0] for i in range(self.chunks_count[1])]
-
-        def restore_chunk(i, j):
-            self.chunks[i][j] = [[None] * self.CHUNK_SIZE for k in range(self.CHUNK_SIZE)]
-            for n in range(self.CHUNK_SIZE):
-                    for m in range(self.CHUNK_SIZE):
-                        self.chunks[i][j][n][m] = self.id_dict[binary_chunks[i][j][n][m][0]](
-                            binary_chunks[i][j][n][m][1],
-                            binary_chunks[i][j][n][m][2]
-                        )
-        
-        threads = []
-
-        for i in range(self.chunks_count[0]):
-            for j in range(self.chunks_count[1]):
-                threads.append(threading.Thread(target=restore_chunk, args=(i, j)))
-                threads[-1].start()
-
-        for thread in threads:
-            thread.join()
+    def from_binary(self, data, pool=None):
+        self.chunks = OrderedDict()
+        self.chunk_surfaces = {}
+        self.chunk_surface_build = None
+        self.load_chunks_from_binary(data, pool)
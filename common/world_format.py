@@ -0,0 +1,140 @@
+import struct
+import zlib
+import numpy as np
+
+# Binary world format, all numbers are big endian.
+#
+# header: magic, version, chunk size, chunks count (x, y, -1 for infinite worlds),
+#         number of chunks
+# then for every chunk:
+#   chunk header: chunk_x, chunk_y, flags, payload length
+#   payload: ids (uint8, chunk_size * chunk_size) followed by data (same layout),
+#            zlib compressed when FLAG_COMPRESSED is set
+#
+# Block changes, sent instead of whole chunks after edits:
+#   number of chunks, then for every chunk:
+#   changes header: chunk_x, chunk_y, version of the chunk after the changes, number of changes
+#   then for every change: block_x, block_y, id, data
+
+MAGIC = b'MWF'
+VERSION = 1
+
+HEADER = struct.Struct('!3sBHiiI')
+CHUNK_HEADER = struct.Struct('!iiBI')
+
+CHANGES_HEADER = struct.Struct('!I')
+CHUNK_CHANGES_HEADER = struct.Struct('!iiIH')
+CHANGE_RECORD = struct.Struct('!BBBB')
+
+FLAG_COMPRESSED = 1
+
+BLOCK_DTYPE = np.uint8
+
+
+class FormatError(ValueError):
+    pass
+
+
+def encode_chunk(pos, ids, data, compress=True):
+    payload = ids.astype(BLOCK_DTYPE, copy=False).tobytes() + data.astype(BLOCK_DTYPE, copy=False).tobytes()
+    flags = 0
+
+    if compress:
+        compressed = zlib.compress(payload)
+        # tiny or noisy chunks can grow when compressed
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_COMPRESSED
+
+    return CHUNK_HEADER.pack(pos[0], pos[1], flags, len(payload)) + payload
+
+
+def encode_world(chunk_size, chunks_count, chunks, compress=True):
+    'chunks: iterable of (pos, ids, data)'
+    encoded = [encode_chunk(pos, ids, data, compress) for pos, ids, data in chunks]
+    if chunks_count is None:
+        chunks_count = (-1, -1)
+    header = HEADER.pack(MAGIC, VERSION, chunk_size, chunks_count[0], chunks_count[1], len(encoded))
+    return b''.join([header] + encoded)
+
+
+def decode_world(buffer):
+    '''
+    returns (chunk_size, chunks_count, [(pos, ids, data), ...])
+    uncompressed chunks are decoded without copying, the arrays are views into buffer
+    '''
+    view = memoryview(buffer)
+    if len(view) < HEADER.size:
+        raise FormatError('truncated header')
+
+    magic, version, chunk_size, count_x, count_y, chunks_number = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise FormatError(f'bad magic {magic!r}')
+    if version != VERSION:
+        raise FormatError(f'unsupported version {version}')
+
+    offset = HEADER.size
+    chunks = []
+
+    for _ in range(chunks_number):
+        chunk, offset = decode_chunk(view, offset, chunk_size)
+        chunks.append(chunk)
+
+    chunks_count = (count_x, count_y) if count_x >= 0 else None
+    return chunk_size, chunks_count, chunks
+
+
+def decode_chunk(view, offset, chunk_size):
+    'decodes the chunk at offset, returns ((pos, ids, data), offset after the chunk)'
+    area = chunk_size * chunk_size
+
+    if offset + CHUNK_HEADER.size > len(view):
+        raise FormatError('truncated chunk header')
+    chunk_x, chunk_y, flags, length = CHUNK_HEADER.unpack_from(view, offset)
+    offset += CHUNK_HEADER.size
+
+    if offset + length > len(view):
+        raise FormatError(f'truncated chunk {(chunk_x, chunk_y)}')
+    payload = view[offset:offset + length]
+    offset += length
+
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    if len(payload) != 2 * area:
+        raise FormatError(f'bad payload size for chunk {(chunk_x, chunk_y)}')
+
+    ids = np.frombuffer(payload, dtype=BLOCK_DTYPE, count=area).reshape(chunk_size, chunk_size)
+    data = np.frombuffer(payload, dtype=BLOCK_DTYPE, count=area, offset=area).reshape(chunk_size, chunk_size)
+    return ((chunk_x, chunk_y), ids, data), offset
+
+
+def encode_changes(chunks):
+    'chunks: list of (pos, version, [(block_x, block_y, id, data), ...])'
+    parts = [CHANGES_HEADER.pack(len(chunks))]
+    for pos, version, changes in chunks:
+        parts.append(CHUNK_CHANGES_HEADER.pack(pos[0], pos[1], version, len(changes)))
+        parts.extend(CHANGE_RECORD.pack(*change) for change in changes)
+    return b''.join(parts)
+
+
+def decode_changes(buffer):
+    'returns [(pos, version, [(block_x, block_y, id, data), ...]), ...]'
+    view = memoryview(buffer)
+    if len(view) < CHANGES_HEADER.size:
+        raise FormatError('truncated changes header')
+    chunks_number, = CHANGES_HEADER.unpack_from(view, 0)
+    offset = CHANGES_HEADER.size
+
+    chunks = []
+    for _ in range(chunks_number):
+        if offset + CHUNK_CHANGES_HEADER.size > len(view):
+            raise FormatError('truncated chunk changes header')
+        chunk_x, chunk_y, version, count = CHUNK_CHANGES_HEADER.unpack_from(view, offset)
+        offset += CHUNK_CHANGES_HEADER.size
+
+        if offset + count * CHANGE_RECORD.size > len(view):
+            raise FormatError(f'truncated changes of chunk {(chunk_x, chunk_y)}')
+        changes = list(CHANGE_RECORD.iter_unpack(view[offset:offset + count * CHANGE_RECORD.size]))
+        offset += count * CHANGE_RECORD.size
+        chunks.append(((chunk_x, chunk_y), version, changes))
+    return chunks
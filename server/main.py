@@ -1,117 +1,999 @@
 from os import read
+import argparse
+import asyncio
+import math
+import multiprocessing
 import socket
-import cloudpickle as pickle
 from dataclasses import dataclass
 import select
+import signal
 import threading
+import time
+import traceback
+import random
 import sys
 
 sys.path.append('../')
 
-from common.world import World, generate_perlin_noise_2d
-from common.utils import recvall, sendall
+from common.world import World, ChunkGenerator, generate_perlin_noise_2d
+from common.utils import recvall, sendall, recvall_async, sendall_async
+from common import framing
+from common.framing import FrameDecoder, FrameError, send_frames, encode_frame
+from common.parallel import ChunkPool
 from common.player import Player
+from common import protocol
+from common import snapshot
+from common import datagram
+from common.world_format import encode_changes, encode_chunk, decode_chunk
+from registry import UserRegistry, SpatialHash
+from metrics import Metrics, MetricsServer
+from sharding import ShardMap, Shard, FrontEnd
 
 # print(generate_perlin_noise_2d((10, 10), (2, 2)))
 # exit()
 
+def open_world(world_path, world_size, seed):
+    'loads the world saved at world_path or creates a new one there'
+    if World.is_saved(world_path):
+        print(f'Loading world from {world_path}...')
+        world = World(max_loaded_chunks=4096)
+        world.load(world_path)
+        print('World loaded!')
+    else:
+        if seed is None:
+            seed = random.getrandbits(63)
+        print(f'Creating world with seed {seed}...')
+        # chunks are generated when they are first requested
+        generator = ChunkGenerator(seed, World().CHUNK_SIZE)
+        world = World(world_size, max_loaded_chunks=4096, generator=generator)
+        world.save(world_path, wait=True)
+        print(f'World saved to {world_path}')
+    return world
+
 class Server():
     @dataclass 
     class User():
         addres: str
         socket: socket.socket
         player: Player
+        id: int = 0
+        # last snapshot applied by the client, deltas are sent against it
+        acked_seq: int = 0
+        # last position received from the client, echoed in snapshots
+        input_seq: int = 0
+        # snapshots up to this seq were not sent by this server, their acks are ignored
+        joined_seq: int = 0
+        # chunk position -> version of the chunk the client has, None if unknown
+        chunk_versions: dict = None
+        snapshots: snapshot.SnapshotHistory = None
+        decoder: FrameDecoder = None
+        # frames are compressed only with codecs the client decodes
+        policy: framing.CompressionPolicy = None
+        # udp channel, snapshots go over udp once the client sent a datagram
+        token: bytes = None
+        udp_addres: tuple = None
+        # seq of the first snapshot that could go over udp
+        udp_seq: int = 0
+        # snapshots went unacknowledged for too long, they are sent over tcp again
+        udp_failed: bool = False
+        # asyncio mode only
+        writer: asyncio.StreamWriter = None
+        queue: asyncio.Queue = None
 
 
-    def init_socket(self):
+    def init_socket(self, port):
         main_socket = socket.socket(
             socket.AF_INET,
             socket.SOCK_STREAM,
         )
 
-        main_socket.bind(('localhost', 1236))
+        main_socket.bind(('localhost', port))
         main_socket.listen()
 
         return main_socket
 
-    def __init__(self):
-        self.main_socket = self.init_socket()
-        self.users = []
+    def init_udp_socket(self, port):
+        udp_socket = socket.socket(
+            socket.AF_INET,
+            socket.SOCK_DGRAM,
+        )
+
+        udp_socket.bind(('localhost', port))
+        udp_socket.setblocking(False)
+
+        return udp_socket
+
+    def __init__(self, tick_rate=20, world_path='world', autosave_period=60, world_size=(32, 32), seed=None, workers=0, port=1236, udp=False, shard=None):
+        '''
+        world_size None makes an infinite world, seed None picks a random one,
+        workers > 0 generates requested chunks in that many processes,
+        udp sends player state over udp on the same port as well,
+        shard makes this server one sharding.Shard of the sharded mode
+        '''
+        self.main_socket = self.init_socket(port)
+        self.port = port
+        self.udp_socket = self.init_udp_socket(port) if udp else None
+        self.users = UserRegistry()
         self.is_running = False
+        self.metrics = Metrics()
+
+        self.tick_rate = tick_rate
+        # positions received since the last tick, applied by the tick loop
+        self.player_inputs = []
+        self.next_player_id = 1
+        self.last_seq = 0
+        self.tick_times = []
+        self.tick_report_period = 10
 
-        print('Creating world...')
-        self.world = World((32, 32))
-        #self.world.generate_random_wolrd()
-        self.world.generate_world_from_perlin_noise()
-        print('World generated!')
+        # chunks are sent nearest first, the rest is requested again by the client
+        self.max_chunks_per_request = 25
+        self.chunks_per_message = 5
+        # requests of chunks further from the player are dropped
+        self.max_view_distance = 8
+        # chunks further from the player are assumed unloaded by the client,
+        # it gets no changes of them and requests them again when it needs them;
+        # clients keep one more row than they request, and the player here
+        # can be a chunk behind the one of the client
+        self.tracked_chunks_radius = self.max_view_distance + 2
+        # blocks further from the player than this can not be changed by it
+        self.edit_distance = 8
+
+        # dirty chunks are written in the background this often, in seconds
+        self.autosave_period = autosave_period
+        self.last_save_time = time.time()
+
+        # seconds without acknowledged snapshots before a user is switched back to tcp
+        self.udp_timeout = 2
+
+        with self.metrics.timer('world.open'):
+            self.world = open_world(world_path, world_size, seed)
+
+        self.pool = ChunkPool(workers) if workers > 0 else None
+
+        # users only receive players that are this many chunks away or closer
+        self.interest_radius = 2
+        self.players_grid = SpatialHash(self.world.CHUNK_SIZE * 64)
+
+        self.shard = shard
+        self.report_prefix = f'[shard {shard.index}] ' if shard is not None else ''
+        # player_id -> ((x, y), name) of players near the border in other shards
+        self.ghosts = {}
+        # seconds between checks of the copies of chunks of other shards the users have
+        self.chunk_check_period = 1
+        self.last_chunk_check_time = 0
 
         self.lock = threading.Lock()
 
+        self.metrics.add_gauge('users', lambda: len(self.users))
+        self.metrics.add_gauge('queued_inputs', lambda: len(self.player_inputs))
+        self.metrics.add_gauge('loaded_chunks', lambda: len(self.world.chunks))
+        self.metrics.add_gauge('dirty_chunks', lambda: len(self.world.dirty_chunks))
+        self.metrics.add_gauge('save_queue', lambda: self.world.storage.queue.qsize())
+
     def is_known_addres(self, addres):
-        is_known = False
-        for user in self.users:
-            if user.addres == addres:
-                is_known = True
-                break
-        return is_known
+        return self.users.is_known_addres(addres)
+
+    def get_user_by_socket(self, socket):
+        return self.users.get_by_socket(socket)
+
+    def add_user(self, user):
+        user.snapshots = snapshot.SnapshotHistory()
+        user.decoder = FrameDecoder()
+        if user.chunk_versions is None:
+            user.chunk_versions = {}
+        with self.lock:
+            self.users.add(user)
+            self.players_grid.update(user.id, user.player.pos)
+        self.metrics.add_connection(user.id, user.addres)
+        self.resend_unknown_chunks(user)
+
+    def resend_unknown_chunks(self, user):
+        '''
+        chunks of the regions of this shard that a user joined from another
+        shard has, its copies may have missed changes that did not reach that shard
+        '''
+        if self.shard is None:
+            return
+        positions = [
+            pos for pos, version in user.chunk_versions.items()
+            if version is None and self.shard.is_owned(pos)
+        ]
+        if positions:
+            self.on_chunks_request(user, positions)
 
     def on_new_user(self, socket, addres):
-        world_data = self.world.to_binary()
-        sendall(socket, world_data)
-        player = pickle.loads(recvall(socket))
-        self.users.append(Server.User(socket=socket, addres=addres, player=player))
+        world_info = (self.world.CHUNK_SIZE, self.world.chunks_count)
+        try:
+            sendall(socket, protocol.pack(protocol.WORLD_INFO, world_info))
+            data = recvall(socket)
+        except (OSError, FrameError):
+            data = None
+        # closed before the handshake was done
+        if data is None:
+            socket.close()
+            return
+        join = self.parse_join(data)
+        if join is None:
+            socket.close()
+            return
+
+        player, player_id, joined_seq, chunk_versions, codecs = join
+        user = Server.User(
+            socket=socket, addres=addres, player=player, id=player_id,
+            joined_seq=joined_seq, chunk_versions=chunk_versions,
+            policy=framing.default_policy.for_codecs(codecs), token=self.new_token()
+        )
+        sendall(socket, protocol.pack(protocol.PLAYER_ID, user.id))
+        if user.token is not None:
+            sendall(socket, protocol.pack(protocol.SESSION, (user.token, self.port)))
+        self.add_user(user)
+
+    def parse_join(self, data):
+        '''
+        returns (player, player_id, joined_seq, chunk_versions, codecs) of the
+        first message of a client or, in a shard, of the sharding front-end,
+        None if it is neither
+        '''
+        kind, payload = protocol.unpack(data)
+        # a shard only takes players from the front-end, the ids it picks
+        # would collide with the ones of a client that connects directly
+        if (kind == protocol.JOIN) != (self.shard is not None):
+            return None
+        if kind == protocol.PLAYER:
+            player, codecs = protocol.unpack_player(payload)
+            if not all(math.isfinite(value) for value in player.pos):
+                return None
+            return player, self.get_new_player_id(), self.last_seq, {}, codecs
+        if kind == protocol.JOIN:
+            player, player_id, seq, chunk_positions, codecs = payload
+            # the front-end picks ids, they stay the same in every shard,
+            # chunks of this shard the client has are sent again right after
+            # the join, the others whole when they change
+            return player, player_id, max(self.last_seq, seq), dict.fromkeys(chunk_positions), codecs
+        return None
+
+    def new_token(self):
+        'session token of a new user, None when udp is disabled'
+        return datagram.new_token() if self.udp_socket is not None else None
+
+    def get_new_player_id(self):
+        player_id = self.next_player_id
+        self.next_player_id += 1
+        return player_id
+
+    def send(self, user, data):
+        self.send_many(user, [data])
+
+    def send_many(self, user, messages):
+        # the tick loop and handle_tcp write to the same sockets
+        try:
+            with self.lock:
+                sent = send_frames(user.socket, messages, user.policy)
+            self.metrics.on_sent(user.id, sent, len(messages))
+        except OSError:
+            self.on_user_disconnect(user.socket)
 
     def on_user_disconnect(self, socket):
-        for user in self.users:
-            if user.socket is socket:
+        with self.lock:
+            user = self.users.get_by_socket(socket)
+            if user is not None:
                 self.users.remove(user)
-                break
+                self.players_grid.remove(user.id)
+        if user is not None:
+            self.metrics.remove_connection(user.id)
+
+    def drop_user(self, socket):
+        'disconnects a user whose messages can not be read'
+        self.on_user_disconnect(socket)
+        socket.close()
+
+    def send_datagram(self, user, data):
+        try:
+            self.udp_socket.sendto(data, user.udp_addres)
+            self.metrics.on_sent(user.id, len(data), 1)
+        except OSError:
+            # udp errors are not fatal, the next snapshot is tried again
+            self.metrics.count('datagrams.errors')
+
+    def on_datagram(self, data, addres):
+        try:
+            kind, token, payload = datagram.unpack(data)
+        except datagram.DatagramError:
+            kind, token, payload = None, None, None
+        user = self.users.get_by_token(token)
+        if user is None:
+            self.metrics.count('datagrams.rejected')
+            return
+
+        self.metrics.count(f'datagrams.{datagram.KIND_NAMES.get(kind, kind)}')
+        self.metrics.on_received(user.id, len(data), 1)
+        if user.udp_addres is None:
+            user.udp_seq = self.last_seq + 1
+        # the latest address wins, NATs may change the port
+        user.udp_addres = addres
+        if kind == datagram.POSITION and len(payload) == snapshot.POSITION_RECORD.size:
+            self.on_position(user, payload)
+
+    def on_position(self, user, data):
+        if not isinstance(data, bytes) or len(data) != snapshot.POSITION_RECORD.size:
+            self.metrics.count('positions.rejected')
+            return
+        acked_seq, input_seq, x, y = snapshot.POSITION_RECORD.unpack(data)
+        # nan and inf would break the players grid
+        if not (math.isfinite(x) and math.isfinite(y)):
+            self.metrics.count('positions.rejected')
+            return
+        with self.lock:
+            self.player_inputs.append((user, (x, y), acked_seq, input_seq))
+
+    def run_tick(self):
+        'one tick, a failed one is reported and the next ticks run anyway'
+        start = time.perf_counter()
+        try:
+            self.tick()
+        except Exception:
+            self.metrics.count('ticks.failed')
+            traceback.print_exc()
+        self.on_tick_done(time.perf_counter() - start)
+
+    def tick(self):
+        with self.lock:
+            player_inputs, self.player_inputs = self.player_inputs, []
+            users = list(self.users)
+
+        with self.lock:
+            for user, pos, acked_seq, input_seq in player_inputs:
+                # disconnected or handed off since
+                if self.users.get_by_id(user.id) is not user:
+                    continue
+                # positions over udp may come out of order, older ones are dropped
+                if input_seq > user.input_seq:
+                    user.player.pos = list(pos)
+                    user.input_seq = input_seq
+                    self.players_grid.update(user.id, pos)
+                if user.joined_seq < acked_seq <= self.last_seq:
+                    user.acked_seq = max(user.acked_seq, acked_seq)
+
+        if self.shard is not None:
+            users = self.hand_off_users(users)
+            self.update_ghosts()
+
+        positions = dict((player_id, snapshot.quantize(pos)) for player_id, (pos, _) in self.ghosts.items())
+        positions.update((user.id, snapshot.quantize(user.player.pos)) for user in users)
+        names = dict((player_id, name) for player_id, (_, name) in self.ghosts.items())
+        names.update((user.id, user.player.name) for user in users)
+        self.last_seq += 1
+        if self.shard is not None:
+            # shards number ticks by a shared clock, seqs go on after a handoff
+            self.last_seq = max(self.last_seq, self.shard.get_seq(self.tick_rate))
+        seq = self.last_seq
+
+        # every user gets only the players around its own chunk
+        for user in users:
+            cell = self.players_grid.get_cell(user.player.pos)
+            state = dict(
+                (player_id, positions[player_id])
+                for player_id in self.players_grid.query(cell, self.interest_radius)
+                if player_id in positions
+            )
+
+            base = user.snapshots.get(user.acked_seq)
+            base_seq = user.acked_seq if base is not None else 0
+            with self.metrics.timer('serialize.snapshot'):
+                delta = snapshot.encode_delta(seq, base_seq, base, state, names, user.input_seq)
+            if self.can_use_udp(user, seq) and datagram.HEADER.size + len(delta) <= datagram.MAX_SIZE:
+                self.send_datagram(user, datagram.pack(datagram.SNAPSHOT, user.token, delta))
+            else:
+                self.send(user, protocol.pack(protocol.SNAPSHOT, delta))
+            user.snapshots.add(seq, state)
+
+        with self.lock:
+            if self.shard is not None:
+                self.apply_chunk_updates()
+            changed = self.world.take_changed_chunks()
+        if changed:
+            with self.metrics.timer('serialize.blocks'):
+                self.send_block_changes(users, changed)
+
+        if self.shard is not None:
+            self.shard.send_ghosts(
+                [
+                    (user.id, positions[user.id], user.player.name, self.world.get_chunk_pos(user.player.pos))
+                    for user in users
+                ],
+                self.interest_radius
+            )
+            self.send_chunk_updates(changed)
+            self.answer_chunk_checks()
+            if time.time() - self.last_chunk_check_time > self.chunk_check_period:
+                self.check_chunk_copies(users)
+                self.last_chunk_check_time = time.time()
+
+        if time.time() - self.last_save_time > self.autosave_period:
+            with self.lock, self.metrics.timer('world.save'):
+                self.world.save()
+            self.last_save_time = time.time()
+
+    def hand_off_users(self, users):
+        'hands off users that left the regions of this shard, returns the others'
+        staying = []
+        for user in users:
+            chunk_pos = self.world.get_chunk_pos(user.player.pos)
+            if self.shard.is_owned(chunk_pos):
+                staying.append(user)
+            else:
+                self.hand_off(user, self.shard.map.get_owner(chunk_pos))
+        return staying
+
+    def hand_off(self, user, shard):
+        # the front-end joins the client to the other shard, nothing is sent after this
+        data = protocol.pack(protocol.HANDOFF, (shard, user.player, self.last_seq, list(user.chunk_versions)))
+        try:
+            with self.lock:
+                user.socket.sendall(framing.encode_control_frame(data))
+        except OSError:
+            pass
+        self.on_user_disconnect(user.socket)
+        user.socket.close()
+        self.metrics.count('handoffs')
+
+    def update_ghosts(self):
+        ghosts = self.shard.receive_ghosts()
+        with self.lock:
+            # players of this shard are never ghosts, even if the other one still sends them
+            ghosts = dict(
+                (player_id, ghost) for player_id, ghost in ghosts.items()
+                if self.users.get_by_id(player_id) is None
+            )
+            for player_id in self.ghosts:
+                if player_id not in ghosts and self.users.get_by_id(player_id) is None:
+                    self.players_grid.remove(player_id)
+            for player_id, (pos, _) in ghosts.items():
+                self.players_grid.update(player_id, pos)
+        self.ghosts = ghosts
+
+    def apply_chunk_updates(self):
+        'copies of chunks changed by other shards, call with lock held'
+        for pos, (version, record) in self.shard.take_chunk_updates().items():
+            # the chunks of this shard are only changed here
+            if self.shard.is_owned(pos):
+                continue
+            (_, ids, data), _ = decode_chunk(record, 0, self.world.CHUNK_SIZE)
+            self.world.replace_blocks(pos, ids, data, version)
+            self.metrics.count('chunk_updates.received')
+
+    def send_chunk_updates(self, changed):
+        'chunks of this shard in changed, whole to the shards around them'
+        updates = []
+        with self.lock:
+            for pos in changed:
+                chunk = self.world.chunks.get(pos)
+                if chunk is not None and self.shard.is_owned(pos):
+                    updates.append((pos, chunk.version, encode_chunk(pos, chunk.ids, chunk.data)))
+        if updates:
+            self.shard.send_chunk_updates(updates, self.tracked_chunks_radius)
+            self.metrics.count('chunk_updates.sent', len(updates))
+
+    def check_chunk_copies(self, users):
+        '''
+        versions of the copies of chunks of other shards the users have to
+        their owners, copies that missed an update or were evicted and read
+        from a disk older than the owner get sent again
+        '''
+        copies = {}
+        with self.lock:
+            for user in users:
+                for pos in user.chunk_versions:
+                    if pos in copies or self.shard.is_owned(pos):
+                        continue
+                    chunk = self.world.chunks.get(pos)
+                    copies[pos] = chunk.source_version if chunk is not None else None
+        self.shard.send_chunk_checks(list(copies.items()))
+
+    def answer_chunk_checks(self):
+        for shard, copies in self.shard.take_chunk_checks():
+            updates = []
+            with self.lock:
+                for pos, version in copies:
+                    if not self.shard.is_owned(pos):
+                        continue
+                    chunk = self.world.get_chunk(pos)
+                    if chunk is not None and chunk.version != version:
+                        updates.append((pos, chunk.version, encode_chunk(pos, chunk.ids, chunk.data)))
+            if updates:
+                self.shard.answer_chunk_check(shard, updates)
+                self.metrics.count('chunk_updates.resent', len(updates))
+
+    def can_use_udp(self, user, seq):
+        if user.udp_addres is None or user.udp_failed:
+            return False
+        if seq - max(user.acked_seq, user.udp_seq) > self.udp_timeout * self.tick_rate:
+            # datagrams are blocked somewhere on the way
+            print(f'{user.addres} does not receive datagrams, falling back to tcp')
+            user.udp_failed = True
+            return False
+        return True
+
+    def on_tick_done(self, tick_time):
+        self.metrics.observe('tick', tick_time)
+        self.tick_times.append(tick_time)
+        if len(self.tick_times) >= self.tick_rate * self.tick_report_period:
+            overruns = sum(1 for t in self.tick_times if t > 1 / self.tick_rate)
+            print(
+                f'{self.report_prefix}ticks: {len(self.tick_times)}, '
+                f'avg: {1000 * sum(self.tick_times) / len(self.tick_times):.2f} ms, '
+                f'max: {1000 * max(self.tick_times):.2f} ms, '
+                f'overruns: {overruns}, '
+                f'compression: {framing.default_policy.stats}, '
+                f'{self.metrics.get_report()}'
+            )
+            self.tick_times = []
+
+    def on_chunks_request(self, user, positions):
+        positions = [
+            (int(pos[0]), int(pos[1])) for pos in positions
+        ]
+        player_chunk = self.world.get_chunk_pos(user.player.pos)
+        positions = [
+            pos for pos in set(positions)
+            if self.world.is_chunk_in_world(pos)
+            and max(abs(pos[0] - player_chunk[0]), abs(pos[1] - player_chunk[1])) <= self.max_view_distance
+        ]
+        positions.sort(
+            key=lambda pos: (pos[0] - player_chunk[0]) ** 2 + (pos[1] - player_chunk[1]) ** 2
+        )
+        positions = positions[:self.max_chunks_per_request]
+
+        messages = []
+        with self.lock:
+            for pos in list(user.chunk_versions):
+                if max(abs(pos[0] - player_chunk[0]), abs(pos[1] - player_chunk[1])) > self.tracked_chunks_radius:
+                    del user.chunk_versions[pos]
+
+            with self.metrics.timer('world.generate'):
+                self.world.generate_chunks(positions, self.pool)
+            with self.metrics.timer('serialize.chunks'):
+                for i in range(0, len(positions), self.chunks_per_message):
+                    batch = positions[i:i + self.chunks_per_message]
+                    # compressed as a whole by the frame codec, not chunk by chunk
+                    chunks_data = self.world.to_binary(batch, compress=False)
+                    messages.append(protocol.pack(protocol.CHUNKS, chunks_data))
+                    # later changes of these chunks are sent as diffs
+                    for pos in batch:
+                        if pos in self.world.chunks:
+                            user.chunk_versions[pos] = self.world.chunks[pos].version
+        self.metrics.count('chunks_sent', len(positions))
+        self.send_many(user, messages)
+
+    def on_set_block(self, user, payload):
+        block_x, block_y, block_id, data = (int(value) for value in payload)
+        chunk_pos = (block_x // self.world.CHUNK_SIZE, block_y // self.world.CHUNK_SIZE)
+        player_x, player_y = (math.floor(value) // 64 for value in user.player.pos)
+
+        if (
+            max(abs(block_x - player_x), abs(block_y - player_y)) > self.edit_distance
+            or not self.world.is_valid_block(block_id, data)
+            or not self.world.is_chunk_in_world(chunk_pos)
+            # regions of other shards are changed by them
+            or (self.shard is not None and not self.shard.is_owned(chunk_pos))
+        ):
+            self.metrics.count('set_block.rejected')
+            return
+
+        with self.lock:
+            self.world.set_block(
+                chunk_pos[0], chunk_pos[1],
+                block_x % self.world.CHUNK_SIZE, block_y % self.world.CHUNK_SIZE,
+                block_id, data
+            )
+
+    def send_block_changes(self, users, changed):
+        '''
+        changes of the chunks in changed to every user that has them, as diffs
+        from the version it has, whole chunks when the journal does not go back that far
+        '''
+        for user in users:
+            positions = [pos for pos in changed if pos in user.chunk_versions]
+            if not positions:
+                continue
+
+            messages = []
+            with self.lock:
+                diffs = []
+                resend = []
+                for pos in positions:
+                    chunk = self.world.chunks.get(pos)
+                    if chunk is None:
+                        continue
+                    changes = self.world.get_changes(pos, user.chunk_versions[pos])
+                    if changes is None:
+                        resend.append(pos)
+                    elif changes:
+                        diffs.append((pos, chunk.version, changes))
+                    user.chunk_versions[pos] = chunk.version
+
+                if diffs:
+                    messages.append(protocol.pack(protocol.BLOCKS, encode_changes(diffs)))
+                if resend:
+                    messages.append(protocol.pack(protocol.CHUNKS, self.world.to_binary(resend, compress=False)))
+            self.metrics.count('block_diffs', len(diffs))
+            self.metrics.count('chunks_resent', len(resend))
+            self.send_many(user, messages)
+
+    def handle_message(self, user, data):
+        kind, payload = protocol.unpack(data)
+        self.metrics.count(f'messages.{kind}')
+
+        with self.metrics.timer(f'handle.{kind}'):
+            if kind == protocol.POSITION:
+                self.on_position(user, payload)
+            elif kind == protocol.CHUNKS_REQUEST:
+                self.on_chunks_request(user, payload)
+            elif kind == protocol.SET_BLOCK:
+                self.on_set_block(user, payload)
+
+    def try_handle_message(self, user, data):
+        'handle_message, False when the message was malformed and the user has to be dropped'
+        try:
+            self.handle_message(user, data)
+        except Exception as e:
+            self.metrics.count('messages.rejected')
+            print(f'{self.report_prefix}{user.addres} sent a malformed message, disconnecting: {e!r}')
+            return False
+        return True
 
     def handle_tcp(self):
         while self.is_running:
             read_list = [self.main_socket]
+            if self.udp_socket is not None:
+                read_list.append(self.udp_socket)
             for user in self.users:
                 read_list.append(user.socket)
 
-            r_sockets, *_ = select.select(read_list, [], [])
+            try:
+                with self.metrics.timer('tcp.select'):
+                    r_sockets, *_ = select.select(read_list, [], [])
+            except (ValueError, OSError):
+                # a socket was closed by a handoff in the meantime, the list is made again
+                continue
             for r_socket in r_sockets:
                 if r_socket is self.main_socket:
                     socket, addres = self.main_socket.accept()
                     print(addres)
 
                     if not self.is_known_addres(addres):
-                        self.on_new_user(socket, addres)
+                        with self.metrics.timer('tcp.handshake'):
+                            self.on_new_user(socket, addres)
+                elif r_socket is self.udp_socket:
+                    self.read_datagrams()
                 else:
-                    data = recvall(r_socket)
-                    
-                    if data is None:
-                        self.on_user_disconnect(socket)
+                    # only what is available is read, partial frames stay in the decoder
+                    user = self.get_user_by_socket(r_socket)
+                    if user is None:
+                        continue
+                    try:
+                        with self.metrics.timer('tcp.read'):
+                            received = user.decoder.recv_into(r_socket)
+                    except ConnectionError:
+                        received = 0
+                    except FrameError:
+                        # frames after a broken one can not be found
+                        self.drop_user(r_socket)
                         continue
 
-                    player = pickle.loads(data)
-                    
-                    for user in self.users:
-                        if user.player.name == player.name:
-                            user.player = player
+                    if received == 0:
+                        self.on_user_disconnect(r_socket)
+                        continue
+
+                    frames = user.decoder.frames()
+                    self.metrics.on_received(user.id, received, len(frames))
+                    for data in frames:
+                        if not self.try_handle_message(user, data):
+                            self.drop_user(r_socket)
                             break
 
-                    other_players = []
-                    for user in self.users:
-                        if user.player.name != player.name:
-                            other_players.append(user.player)
-                    sendall(r_socket, pickle.dumps(other_players))
-                    
+    def read_datagrams(self):
+        while True:
+            try:
+                data, addres = self.udp_socket.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # icmp errors of earlier sends, the next datagram is read
+                continue
+            self.on_datagram(data, addres)
+
+    def get_next_tick(self, next_tick):
+        '(time of the tick after next_tick, seconds to sleep until it)'
+        # fixed rate, ticks that run late are not made up for
+        next_tick = max(next_tick + 1 / self.tick_rate, time.perf_counter())
+        # the clock moves on after the max, time.sleep raises on negative delays
+        return next_tick, max(0., next_tick - time.perf_counter())
 
     def handle_world(self):
-        pass
+        next_tick = time.perf_counter()
+        while self.is_running:
+            self.run_tick()
+            next_tick, delay = self.get_next_tick(next_tick)
+            time.sleep(delay)
+
+    def shutdown(self):
+        'stops ticking and writes every changed chunk, called in the main thread when the server stops'
+        # a second Ctrl-C or SIGTERM does not cut the save short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.is_running = False
+        print('Saving world...')
+        with self.lock:
+            self.world.save(wait=True)
+        print('World saved')
 
     def run(self):
         self.is_running = True
-        tcp_thread = threading.Thread(target=self.handle_tcp)
+        # daemons, the process exits once the world is saved
+        tcp_thread = threading.Thread(target=self.handle_tcp, daemon=True)
         tcp_thread.start()
-        world_thread = threading.Thread(target=self.handle_world)
+        world_thread = threading.Thread(target=self.handle_world, daemon=True)
         world_thread.start()
+        try:
+            # the chunk pool stops taking work once the main thread exits
+            tcp_thread.join()
+            world_thread.join()
+        finally:
+            self.shutdown()
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server) -> None:
+        self.server = server
+
+    def datagram_received(self, data, addres):
+        self.server.on_datagram(data, addres)
+
+
+class AsyncServer(Server):
+    'Every connection gets a reader task and a writer task with a bounded outbound queue'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.main_socket.setblocking(False)
+
+        # slow clients are disconnected when their queue is full
+        self.max_queued_messages = 256
+        # the reader stops reading requests until the writer catches up
+        self.queue_high_water = 32
+        self.handshake_timeout = 10
+        self.udp_transport = None
+
+        self.metrics.add_gauge(
+            'max_user_queue', lambda: max((user.queue.qsize() for user in self.users), default=0)
+        )
+
+    def send_many(self, user, messages):
+        try:
+            for data in messages:
+                user.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            print(f'{user.addres} is too slow, disconnecting')
+            user.writer.close()
+
+    async def on_new_user_async(self, reader, writer, addres):
+        world_info = (self.world.CHUNK_SIZE, self.world.chunks_count)
+        await sendall_async(writer, protocol.pack(protocol.WORLD_INFO, world_info))
+
+        data = await asyncio.wait_for(recvall_async(reader), self.handshake_timeout)
+        if data is None:
+            return None
+        join = self.parse_join(data)
+        if join is None:
+            return None
+
+        player, player_id, joined_seq, chunk_versions, codecs = join
+        user = Server.User(
+            socket=writer.get_extra_info('socket'),
+            addres=addres,
+            player=player,
+            id=player_id,
+            joined_seq=joined_seq,
+            chunk_versions=chunk_versions,
+            policy=framing.default_policy.for_codecs(codecs),
+            token=self.new_token(),
+            writer=writer,
+            queue=asyncio.Queue(self.max_queued_messages)
+        )
+        await sendall_async(writer, protocol.pack(protocol.PLAYER_ID, user.id))
+        if user.token is not None:
+            await sendall_async(writer, protocol.pack(protocol.SESSION, (user.token, self.port)))
+        self.add_user(user)
+        return user
+
+    async def write_messages(self, user):
+        while True:
+            # everything queued so far goes out in one write
+            messages = [await user.queue.get()]
+            while not user.queue.empty():
+                messages.append(user.queue.get_nowait())
+
+            try:
+                if not user.writer.is_closing():
+                    sent = 0
+                    for data in messages:
+                        header, payload = encode_frame(data, user.policy)
+                        user.writer.writelines((header, payload))
+                        sent += len(header) + len(payload)
+                    self.metrics.on_sent(user.id, sent, len(messages))
+                    await user.writer.drain()
+            except ConnectionError:
+                user.writer.close()
+            finally:
+                for _ in messages:
+                    user.queue.task_done()
+
+    async def handle_connection(self, reader, writer):
+        addres = writer.get_extra_info('peername')
+        print(addres)
+
+        user = None
+        writer_task = None
+        try:
+            if self.is_known_addres(addres):
+                return
+            user = await self.on_new_user_async(reader, writer, addres)
+            if user is None:
+                return
+
+            writer_task = asyncio.create_task(self.write_messages(user))
+            while self.is_running:
+                if user.queue.qsize() >= self.queue_high_water:
+                    await user.queue.join()
+
+                received = await reader.read(len(user.decoder.buffer))
+                if not received:
+                    break
+                user.decoder.feed(received)
+                frames = user.decoder.frames()
+                self.metrics.on_received(user.id, len(received), len(frames))
+                for data in frames:
+                    if not self.try_handle_message(user, data):
+                        return
+        except (ConnectionError, asyncio.TimeoutError, FrameError):
+            pass
+        finally:
+            if writer_task is not None:
+                writer_task.cancel()
+            if user is not None:
+                self.on_user_disconnect(user.socket)
+            writer.close()
+
+    def send_datagram(self, user, data):
+        self.udp_transport.sendto(data, user.udp_addres)
+        self.metrics.on_sent(user.id, len(data), 1)
+
+    async def handle_world_async(self):
+        next_tick = time.perf_counter()
+        while self.is_running:
+            self.run_tick()
+            next_tick, delay = self.get_next_tick(next_tick)
+            await asyncio.sleep(delay)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, sock=self.main_socket)
+        if self.udp_socket is not None:
+            self.udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: DatagramProtocol(self), sock=self.udp_socket
+            )
+        world_task = asyncio.create_task(self.handle_world_async())
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        self.is_running = True
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.shutdown()
+
+
+def start_monitoring(server, metrics_port, profile):
+    if metrics_port:
+        MetricsServer(server.metrics, metrics_port).start()
+        print(f'Metrics on http://localhost:{metrics_port}/metrics')
+    if profile:
+        server.metrics.profiler.start()
+
+
+def exit_on_sigterm():
+    'SIGTERM stops the server like Ctrl-C does, the world is saved on the way out'
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+
+def run_shard(index, shard_map, ports, epoch, args):
+    exit_on_sigterm()
+    shard = Shard(index, shard_map, ports, epoch)
+    server = Server(
+        args.tick_rate, args.world, args.autosave_period, None, None, args.workers, ports[index], shard=shard
+    )
+    # every shard has its own endpoint, on the ports after metrics_port
+    start_monitoring(server, args.metrics_port and args.metrics_port + index, args.profile)
+    server.run()
+
+
+def run_sharded(args, world_size):
+    '''
+    Front-end on args.port in this process, args.shards shard processes on
+    the ports after it. The world is created before the shards start, so
+    that they all load the same one.
+    '''
+    world = open_world(args.world, world_size, args.seed)
+    world_info = (world.CHUNK_SIZE, world.chunks_count)
+    world.storage.close()
+
+    shard_map = ShardMap(args.shards)
+    ports = [args.port + 1 + index for index in range(args.shards)]
+    epoch = time.time()
+    # forked, the shards run the Server of this module without parsing the arguments again
+    context = multiprocessing.get_context('fork')
+    shards = [
+        context.Process(target=run_shard, args=(index, shard_map, ports, epoch, args))
+        for index in range(args.shards)
+    ]
+    # terminate stops the shards too, they save their chunks first
+    exit_on_sigterm()
+    for shard in shards:
+        shard.start()
+
+    try:
+        FrontEnd(args.port, ports, shard_map, world_info).run()
+    finally:
+        for shard in shards:
+            shard.terminate()
+        for shard in shards:
+            shard.join()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--asyncio', action='store_true', help='use the asyncio server core')
+parser.add_argument('--port', type=int, default=1236)
+parser.add_argument('--udp', action='store_true', help='send player state over udp on the same port as well')
+parser.add_argument('--tick-rate', type=int, default=20, help='world updates per second')
+parser.add_argument(
+    '--codec', choices=framing.CODEC_NAMES.keys(), default='zlib',
+    help='codec for big frames, zlib when it is not installed here or on the client'
+)
+parser.add_argument('--compression-level', type=int, default=1)
+parser.add_argument('--compression-min-size', type=int, default=512, help='smaller frames are not compressed')
+parser.add_argument('--world', default='world', help='directory the world is loaded from and saved to')
+parser.add_argument('--autosave-period', type=float, default=60, help='seconds between saves of changed chunks')
+parser.add_argument('--metrics-port', type=int, default=0, help='port of the local metrics endpoint, 0 to disable')
+parser.add_argument('--profile', action='store_true', help='start the sampling profiler right away')
+parser.add_argument('--workers', type=int, default=0, help='processes generating chunks, 0 to generate in place')
+parser.add_argument('--seed', type=int, help='seed of a new world, random by default')
+parser.add_argument(
+    '--size', type=int, default=32,
+    help='chunks along each side of a new world, 0 for an infinite world'
+)
+parser.add_argument(
+    '--shards', type=int, default=0,
+    help='worker processes owning regions of the world, 0 to run in one process; '
+    'shards listen on the ports after --port and use the default core without udp'
+)
+args = parser.parse_args()
 
+framing.default_policy = framing.CompressionPolicy(
+    framing.CODEC_NAMES[args.codec],
+    level=args.compression_level,
+    min_size=args.compression_min_size
+)
 
-server = Server()
-server.run()
\ No newline at end of file
+world_size = (args.size, args.size) if args.size > 0 else None
+if args.shards > 0:
+    run_sharded(args, world_size)
+else:
+    server_class = AsyncServer if args.asyncio else Server
+    server = server_class(
+        args.tick_rate, args.world, args.autosave_period,
+        world_size, args.seed, args.workers, args.port, args.udp
+    )
+    start_monitoring(server, args.metrics_port, args.profile)
+    exit_on_sigterm()
+    server.run()
\ No newline at end of file
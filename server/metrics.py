@@ -0,0 +1,287 @@
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# upper bounds of histogram buckets, in seconds
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+
+class Histogram():
+    'counts of values per bucket, the last bucket has no upper bound'
+
+    def __init__(self, bounds=TIME_BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def get_percentile(self, p):
+        'upper bound of the bucket with the p-th value, max for the last bucket'
+        if self.count == 0:
+            return 0.
+        rank = p * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.get_percentile(0.5),
+            'p99': self.get_percentile(0.99),
+            'buckets': dict(zip([str(bound) for bound in self.bounds] + ['inf'], self.counts)),
+        }
+
+
+class ConnectionStats():
+    def __init__(self, addres) -> None:
+        self.addres = addres
+        self.connected_time = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+
+    def to_dict(self):
+        return {
+            'addres': str(self.addres),
+            'connected_s': time.time() - self.connected_time,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+        }
+
+
+class SamplingProfiler():
+    '''
+    Samples stacks of all threads every interval seconds, costs nothing
+    while stopped. Results are in the collapsed format of flame graph tools:
+    "thread;outer function;...;inner function count"
+    '''
+
+    def __init__(self, interval=0.005) -> None:
+        self.interval = interval
+        self.samples = Counter()
+        self.thread = None
+        self.started_time = None
+
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self, interval=None):
+        if self.is_running():
+            return
+        if interval is not None:
+            self.interval = interval
+        self.samples = Counter()
+        self.started_time = time.time()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+
+    def sample(self):
+        this_thread = threading.get_ident()
+        while self.thread is not None:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == this_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def to_text(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+class Metrics():
+    'Counters, time histograms, gauges and per connection traffic of the server'
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started_time = time.time()
+        self.counters = Counter()
+        self.histograms = {}
+        # name -> function returning the current value
+        self.gauges = {}
+        # user id -> ConnectionStats
+        self.connections = {}
+        self.profiler = SamplingProfiler()
+
+        # counters at the last report, reports show what changed since then
+        self.reported_counters = Counter()
+        self.reported_time = time.time()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def add_gauge(self, name, function):
+        self.gauges[name] = function
+
+    def add_connection(self, user_id, addres):
+        with self.lock:
+            self.connections[user_id] = ConnectionStats(addres)
+
+    def remove_connection(self, user_id):
+        with self.lock:
+            self.connections.pop(user_id, None)
+
+    def on_received(self, user_id, bytes_count, messages_count):
+        with self.lock:
+            self.counters['bytes_in'] += bytes_count
+            self.counters['messages_in'] += messages_count
+            connection = self.connections.get(user_id)
+            if connection is not None:
+                connection.bytes_in += bytes_count
+                connection.messages_in += messages_count
+
+    def on_sent(self, user_id, bytes_count, messages_count):
+        with self.lock:
+            self.counters['bytes_out'] += bytes_count
+            self.counters['messages_out'] += messages_count
+            connection = self.connections.get(user_id)
+            if connection is not None:
+                connection.bytes_out += bytes_count
+                connection.messages_out += messages_count
+
+    def get_gauges(self):
+        gauges = {}
+        for name, function in list(self.gauges.items()):
+            try:
+                gauges[name] = function()
+            except Exception as e:
+                gauges[name] = repr(e)
+        return gauges
+
+    def to_dict(self):
+        gauges = self.get_gauges()
+        with self.lock:
+            return {
+                'uptime_s': time.time() - self.started_time,
+                'counters': dict(self.counters),
+                'gauges': gauges,
+                'histograms': dict((name, h.to_dict()) for name, h in self.histograms.items()),
+                'connections': dict((user_id, c.to_dict()) for user_id, c in self.connections.items()),
+                'profiler': self.profiler.is_running(),
+            }
+
+    def get_report(self):
+        'one line with traffic since the last report and the current gauges'
+        gauges = self.get_gauges()
+        with self.lock:
+            now = time.time()
+            period = max(now - self.reported_time, 1e-9)
+            changed = self.counters - self.reported_counters
+            self.reported_counters = self.counters.copy()
+            self.reported_time = now
+
+        return (
+            f'in: {changed["bytes_in"] / period / 1024:.1f} KiB/s {changed["messages_in"] / period:.0f} msg/s, '
+            f'out: {changed["bytes_out"] / period / 1024:.1f} KiB/s {changed["messages_out"] / period:.0f} msg/s, '
+            + ', '.join(f'{name}: {value}' for name, value in gauges.items())
+        )
+
+
+class MetricsServer():
+    '''
+    HTTP endpoint on localhost:
+    GET /metrics - Metrics.to_dict() as JSON
+    GET /profile/start?interval=0.005 - starts the sampling profiler
+    GET /profile/stop - stops it and returns the collapsed stacks
+    GET /profile - collapsed stacks sampled so far
+    '''
+
+    def __init__(self, metrics, port, host='localhost') -> None:
+        self.metrics = metrics
+        self.http_server = ThreadingHTTPServer((host, port), self.get_handler_class())
+        self.http_server.daemon_threads = True
+
+    def get_handler_class(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+
+                if url.path == '/metrics':
+                    self.reply(json.dumps(metrics.to_dict(), indent=4), 'application/json')
+                elif url.path == '/profile/start':
+                    interval = float(query['interval'][0]) if 'interval' in query else None
+                    metrics.profiler.start(interval)
+                    self.reply(f'profiling every {metrics.profiler.interval} s\n')
+                elif url.path == '/profile/stop':
+                    metrics.profiler.stop()
+                    self.reply(metrics.profiler.to_text())
+                elif url.path == '/profile':
+                    self.reply(metrics.profiler.to_text())
+                else:
+                    self.send_error(404)
+
+            def reply(self, text, content_type='text/plain'):
+                body = text.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
@@ -0,0 +1,92 @@
+from collections import defaultdict
+
+
+class UserRegistry():
+    'Users indexed by id, name, socket, addres and session token'
+
+    def __init__(self) -> None:
+        self.by_id = {}
+        self.by_name = {}
+        self.by_socket = {}
+        self.by_addres = {}
+        self.by_token = {}
+
+    def add(self, user):
+        self.by_id[user.id] = user
+        self.by_name[user.player.name] = user
+        self.by_socket[user.socket] = user
+        self.by_addres[user.addres] = user
+        if user.token is not None:
+            self.by_token[user.token] = user
+
+    def remove(self, user):
+        if self.by_id.pop(user.id, None) is None:
+            return
+        if self.by_name.get(user.player.name) is user:
+            del self.by_name[user.player.name]
+        self.by_socket.pop(user.socket, None)
+        self.by_addres.pop(user.addres, None)
+        self.by_token.pop(user.token, None)
+
+    def get_by_id(self, user_id):
+        return self.by_id.get(user_id)
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def get_by_socket(self, socket):
+        return self.by_socket.get(socket)
+
+    def get_by_token(self, token):
+        return self.by_token.get(token)
+
+    def is_known_addres(self, addres):
+        return addres in self.by_addres
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class SpatialHash():
+    'Uniform grid over positions, one cell per chunk'
+
+    def __init__(self, cell_size) -> None:
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)
+        # id -> cell
+        self.positions = {}
+
+    def get_cell(self, pos):
+        return (int(pos[0] // self.cell_size), int(pos[1] // self.cell_size))
+
+    def update(self, item_id, pos):
+        cell = self.get_cell(pos)
+        old_cell = self.positions.get(item_id)
+        if old_cell == cell:
+            return
+
+        if old_cell is not None:
+            self.cells[old_cell].discard(item_id)
+            if not self.cells[old_cell]:
+                del self.cells[old_cell]
+        self.cells[cell].add(item_id)
+        self.positions[item_id] = cell
+
+    def remove(self, item_id):
+        cell = self.positions.pop(item_id, None)
+        if cell is None:
+            return
+        self.cells[cell].discard(item_id)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def query(self, cell, radius):
+        'ids in the square of cells around cell'
+        found = []
+        for i in range(cell[0] - radius, cell[0] + radius + 1):
+            for j in range(cell[1] - radius, cell[1] + radius + 1):
+                found.extend(self.cells.get((i, j), ()))
+        return found
@@ -0,0 +1,327 @@
+import asyncio
+import socket
+import time
+
+from common.framing import FrameSplitter, FrameError, CODEC_CONTROL, HEADER
+from common.region import REGION_SIZE
+from common.utils import recvall_async, sendall_async
+from common import protocol
+
+# Sharded mode: the world is split into square regions of chunks and every
+# region is owned by one shard, a worker process running its own Server.
+# Clients connect to the FrontEnd, which relays their frames to the shard
+# owning the region their player is in. A shard hands a player off when it
+# leaves its regions, and sends players near region borders to the shards
+# owning the regions around them, so that they are visible across borders.
+# Changed chunks are sent to the shards around them the same way, clients
+# see the chunks of other regions through the copies of their shard. Copies
+# read from disk or missing a lost datagram are corrected by their owner
+# when the shard sends it the versions of its copies.
+
+# bigger ghost lists are split, a datagram holds at most 64 KiB
+MAX_GHOSTS_PER_DATAGRAM = 1000
+# a chunk record of 32x32 blocks is at most about 2 KiB
+MAX_CHUNKS_PER_DATAGRAM = 16
+MAX_VERSIONS_PER_DATAGRAM = 1000
+
+
+class ShardMap():
+    '''
+    Owner of every region. Regions are as big as the region files, so that
+    every file is written by one shard only. They are spread over the shards
+    by a hash, players crowding around one place still end up in a few shards.
+    '''
+
+    def __init__(self, shards, region_size=REGION_SIZE) -> None:
+        self.shards = shards
+        self.region_size = region_size
+
+    def get_region(self, chunk_pos):
+        return (chunk_pos[0] // self.region_size, chunk_pos[1] // self.region_size)
+
+    def get_owner_of_region(self, region):
+        return ((region[0] * 73856093) ^ (region[1] * 19349663)) % self.shards
+
+    def get_owner(self, chunk_pos):
+        return self.get_owner_of_region(self.get_region(chunk_pos))
+
+    def get_owners_around(self, chunk_pos, radius):
+        'owners of the regions in the square of chunks around chunk_pos'
+        min_region = self.get_region((chunk_pos[0] - radius, chunk_pos[1] - radius))
+        max_region = self.get_region((chunk_pos[0] + radius, chunk_pos[1] + radius))
+        return set(
+            self.get_owner_of_region((x, y))
+            for x in range(min_region[0], max_region[0] + 1)
+            for y in range(min_region[1], max_region[1] + 1)
+        )
+
+
+class Shard():
+    '''
+    The shard side of the sharded mode, given to Server. Players of other
+    shards near the regions of this one (ghosts) and changed chunks are
+    exchanged as datagrams over localhost, on the udp ports with the numbers
+    of the shard tcp ports.
+    '''
+
+    def __init__(self, index, shard_map, ports, epoch) -> None:
+        self.index = index
+        self.map = shard_map
+        self.ports = ports
+        # shared clock of all shards, snapshot seqs continue after a handoff
+        self.epoch = epoch
+
+        self.ghost_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ghost_socket.bind(('localhost', ports[index]))
+        self.ghost_socket.setblocking(False)
+        # player_id -> ((x, y), name, time received)
+        self.ghosts = {}
+        # ghosts not updated for this long left the border
+        self.ghost_timeout = 0.5
+        # chunk_pos -> (version, chunk record) received since take_chunk_updates
+        self.chunk_updates = {}
+        # [(shard, [(chunk_pos, version)])] received since take_chunk_checks
+        self.chunk_checks = []
+
+    def is_owned(self, chunk_pos):
+        return self.map.get_owner(chunk_pos) == self.index
+
+    def get_seq(self, tick_rate):
+        return int((time.time() - self.epoch) * tick_rate)
+
+    def send_to_shards(self, kind, by_shard, per_datagram):
+        'by_shard: {shard: [item]}, sent as (kind, (index of this shard, items))'
+        for shard, items in by_shard.items():
+            for i in range(0, len(items), per_datagram):
+                data = protocol.pack(kind, (self.index, items[i:i + per_datagram]))
+                try:
+                    self.ghost_socket.sendto(data, ('localhost', self.ports[shard]))
+                except OSError:
+                    # the shard is not up yet or gone
+                    pass
+
+    def send_ghosts(self, players, radius):
+        'players: [(player_id, (x, y), name, chunk_pos)] of this shard'
+        by_shard = {}
+        for player_id, pos, name, chunk_pos in players:
+            for shard in self.map.get_owners_around(chunk_pos, radius):
+                if shard != self.index:
+                    by_shard.setdefault(shard, []).append((player_id, pos[0], pos[1], name))
+        # lost ones are sent again next tick
+        self.send_to_shards(protocol.GHOSTS, by_shard, MAX_GHOSTS_PER_DATAGRAM)
+
+    def send_chunk_updates(self, chunks, radius):
+        '''
+        chunks: [(chunk_pos, version, chunk record)] changed in the regions of
+        this shard, sent whole to the shards with clients up to radius chunks away
+        '''
+        by_shard = {}
+        for update in chunks:
+            for shard in self.map.get_owners_around(update[0], radius):
+                if shard != self.index:
+                    by_shard.setdefault(shard, []).append(update)
+        self.send_to_shards(protocol.CHUNK_UPDATES, by_shard, MAX_CHUNKS_PER_DATAGRAM)
+
+    def send_chunk_checks(self, copies):
+        '''
+        copies: [(chunk_pos, version)] of chunks of other shards,
+        their owners send the ones they have at another version
+        '''
+        by_shard = {}
+        for chunk_pos, version in copies:
+            by_shard.setdefault(self.map.get_owner(chunk_pos), []).append((chunk_pos, version))
+        by_shard.pop(self.index, None)
+        self.send_to_shards(protocol.CHUNK_VERSIONS, by_shard, MAX_VERSIONS_PER_DATAGRAM)
+
+    def answer_chunk_check(self, shard, chunks):
+        'chunks: [(chunk_pos, version, chunk record)] the shard has at other versions'
+        self.send_to_shards(protocol.CHUNK_UPDATES, {shard: chunks}, MAX_CHUNKS_PER_DATAGRAM)
+
+    def receive(self):
+        'reads the datagrams of the other shards'
+        now = time.time()
+        while True:
+            try:
+                data = self.ghost_socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                continue
+            kind, (shard, items) = protocol.unpack(data)
+            if kind == protocol.GHOSTS:
+                for player_id, x, y, name in items:
+                    self.ghosts[player_id] = ((x, y), name, now)
+            elif kind == protocol.CHUNK_UPDATES:
+                # local datagrams come in order, the last one is the newest
+                for chunk_pos, version, record in items:
+                    self.chunk_updates[chunk_pos] = (version, record)
+            elif kind == protocol.CHUNK_VERSIONS:
+                self.chunk_checks.append((shard, items))
+
+    def take_chunk_updates(self):
+        'chunk records received since the last call, {chunk_pos: (version, record)}'
+        self.receive()
+        updates, self.chunk_updates = self.chunk_updates, {}
+        return updates
+
+    def take_chunk_checks(self):
+        'versions of copies received since the last call, [(shard, [(chunk_pos, version)])]'
+        self.receive()
+        checks, self.chunk_checks = self.chunk_checks, []
+        return checks
+
+    def receive_ghosts(self):
+        'reads the ghosts received since the last call, returns {player_id: ((x, y), name)}'
+        now = time.time()
+        self.receive()
+
+        for player_id in [
+            player_id for player_id, (_, _, received) in self.ghosts.items()
+            if now - received > self.ghost_timeout
+        ]:
+            del self.ghosts[player_id]
+        return dict((player_id, (pos, name)) for player_id, (pos, name, _) in self.ghosts.items())
+
+
+class FrontEnd():
+    '''
+    Accepts clients on the public port, does the handshake and relays whole
+    frames between every client and its shard. When the shard sends a
+    HANDOFF control frame the connection is joined to the next shard,
+    the client does not notice.
+    '''
+
+    def __init__(self, port, shard_ports, shard_map, world_info) -> None:
+        self.port = port
+        self.shard_ports = shard_ports
+        self.map = shard_map
+        # (chunk_size, chunks_count) sent to clients
+        self.world_info = world_info
+        self.chunk_size = world_info[0]
+
+        self.next_player_id = 1
+        self.handshake_timeout = 10
+        self.handoffs = 0
+        self.connections = 0
+
+    def get_owner(self, player):
+        chunk_pos = (
+            int(player.pos[0] // (self.chunk_size * 64)),
+            int(player.pos[1] // (self.chunk_size * 64))
+        )
+        return self.map.get_owner(chunk_pos)
+
+    async def join(self, shard, player, player_id, seq, chunk_positions=(), codecs=None):
+        'connects to shard as the player, returns (reader, writer)'
+        for _ in range(100):
+            try:
+                reader, writer = await asyncio.open_connection('localhost', self.shard_ports[shard])
+                break
+            except ConnectionRefusedError:
+                # shards are still starting
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionRefusedError(f'shard {shard} is not running')
+
+        # WORLD_INFO and PLAYER_ID of the shard, the client got them from us
+        await recvall_async(reader)
+        await sendall_async(writer, protocol.pack(protocol.JOIN, (player, player_id, seq, list(chunk_positions), codecs)))
+        await recvall_async(reader)
+        return reader, writer
+
+    async def handle_client(self, reader, writer):
+        addres = writer.get_extra_info('peername')
+        print(addres)
+
+        route = {}
+        try:
+            await sendall_async(writer, protocol.pack(protocol.WORLD_INFO, self.world_info))
+            data = await asyncio.wait_for(recvall_async(reader), self.handshake_timeout)
+            if data is None:
+                return
+            kind, payload = protocol.unpack(data)
+            if kind != protocol.PLAYER:
+                return
+            player, codecs = protocol.unpack_player(payload)
+
+            player_id = self.next_player_id
+            self.next_player_id += 1
+            await sendall_async(writer, protocol.pack(protocol.PLAYER_ID, player_id))
+
+            route['reader'], route['writer'] = await self.join(
+                self.get_owner(player), player, player_id, 0, codecs=codecs
+            )
+            self.connections += 1
+            to_shard = asyncio.create_task(self.relay_to_shard(reader, route))
+            try:
+                await self.relay_to_client(writer, route, player_id, codecs)
+            finally:
+                to_shard.cancel()
+        except (ConnectionError, asyncio.TimeoutError, FrameError):
+            pass
+        finally:
+            if 'writer' in route:
+                self.connections -= 1
+                route['writer'].close()
+            writer.close()
+
+    async def relay_to_shard(self, reader, route):
+        splitter = FrameSplitter()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                # closing the shard connection ends relay_to_client
+                route['writer'].close()
+                return
+            # only whole frames, the shard may change between two of them
+            try:
+                frames = splitter.feed(data)
+            except FrameError:
+                route['writer'].close()
+                return
+            for codec, frame in frames:
+                route['writer'].write(frame)
+            try:
+                await route['writer'].drain()
+            except ConnectionError:
+                # the old shard during a handoff, frames sent to it are lost
+                pass
+
+    async def relay_to_client(self, writer, route, player_id, codecs=None):
+        splitter = FrameSplitter()
+        while True:
+            data = await route['reader'].read(65536)
+            if not data:
+                return
+            for codec, frame in splitter.feed(data):
+                if codec != CODEC_CONTROL:
+                    writer.write(frame)
+                    continue
+
+                kind, payload = protocol.unpack(frame[HEADER.size:])
+                if kind != protocol.HANDOFF:
+                    continue
+                shard, player, seq, chunk_positions = payload
+                # the old shard sends nothing after a handoff
+                route['writer'].close()
+                route['reader'], route['writer'] = await self.join(
+                    shard, player, player_id, seq, chunk_positions, codecs
+                )
+                splitter = FrameSplitter()
+                self.handoffs += 1
+                break
+            await writer.drain()
+
+    async def report(self, period=10):
+        while True:
+            await asyncio.sleep(period)
+            print(f'[front-end] connections: {self.connections}, handoffs: {self.handoffs}')
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client, 'localhost', self.port)
+        report_task = asyncio.create_task(self.report())
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
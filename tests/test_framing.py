@@ -0,0 +1,92 @@
+import socket
+
+import pytest
+
+from common.framing import (
+    HEADER, MAX_FRAME_SIZE, CODEC_NONE, FrameDecoder, FrameSplitter, FrameError,
+    CompressionPolicy, encode_frame, encode_control_frame, get_available_codecs, recv_frame
+)
+from common.utils import sendall
+
+
+def encode(data, codec=CODEC_NONE):
+    header, payload = encode_frame(data, CompressionPolicy(codec, min_size=0, dictionary_max_size=0))
+    return bytes(header) + bytes(payload)
+
+
+@pytest.mark.parametrize('codec', get_available_codecs())
+def test_round_trip(codec):
+    messages = [b'', b'x', bytes(range(256)) * 40]
+    decoder = FrameDecoder()
+    decoder.feed(b''.join(encode(data, codec) for data in messages))
+    assert [bytes(frame) for frame in decoder.frames()] == messages
+
+
+def test_split_headers():
+    messages = [b'abc', b'defgh' * 100]
+    stream = b''.join(encode(data) for data in messages)
+    decoder = FrameDecoder()
+    for i in range(len(stream)):
+        decoder.feed(stream[i:i + 1])
+    assert [bytes(frame) for frame in decoder.frames()] == messages
+
+
+def test_frame_larger_than_buffer():
+    data = bytes(range(256)) * 100
+    decoder = FrameDecoder(buffer_size=1024)
+    stream = encode(data) + encode(b'after')
+    for i in range(0, len(stream), 1000):
+        decoder.feed(stream[i:i + 1000])
+    assert [bytes(frame) for frame in decoder.frames()] == [data, b'after']
+
+
+@pytest.mark.parametrize('length', [MAX_FRAME_SIZE + 1, 2 ** 32 - 5])
+def test_bad_length(length):
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(HEADER.pack(length, CODEC_NONE) + b'abcdefgh')
+    with pytest.raises(FrameError):
+        FrameSplitter().feed(HEADER.pack(length, CODEC_NONE))
+
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(HEADER.pack(length, CODEC_NONE))
+        with pytest.raises(FrameError):
+            recv_frame(b)
+
+
+def test_unknown_codec():
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(HEADER.pack(3, 200) + b'abc')
+
+
+def test_splitter_keeps_frames_whole():
+    stream = encode(b'one') + encode_control_frame(b'two')
+    splitter = FrameSplitter()
+    frames = splitter.feed(stream[:7]) + splitter.feed(stream[7:])
+    assert frames == [(CODEC_NONE, encode(b'one')), (255, encode_control_frame(b'two'))]
+
+
+def test_socket_round_trip():
+    a, b = socket.socketpair()
+    with a, b:
+        sendall(a, b'hello')
+        assert bytes(recv_frame(b)) == b'hello'
+
+
+class NoSendmsgSocket():
+    'a socket without sendmsg, like on windows'
+
+    def __init__(self, s) -> None:
+        self.s = s
+
+    def sendall(self, data):
+        self.s.sendall(data)
+
+
+def test_send_without_sendmsg():
+    a, b = socket.socketpair()
+    with a, b:
+        sendall(NoSendmsgSocket(a), b'hello')
+        sendall(NoSendmsgSocket(a), b'world' * 1000)
+        assert bytes(recv_frame(b)) == b'hello'
+        assert bytes(recv_frame(b)) == b'world' * 1000
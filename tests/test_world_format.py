@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from common.world_format import (
+    FormatError, encode_world, decode_world, encode_chunk, decode_chunk, encode_changes, decode_changes
+)
+
+
+def make_chunk(seed, size=32):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 5, (size, size), dtype=np.uint8), rng.integers(0, 5, (size, size), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('chunks_count', [(4, 4), None])
+def test_world_round_trip(compress, chunks_count):
+    chunks = [((x, -x), *make_chunk(x)) for x in range(3)]
+    chunk_size, decoded_count, decoded = decode_world(encode_world(32, chunks_count, chunks, compress))
+    assert (chunk_size, decoded_count) == (32, chunks_count)
+    assert len(decoded) == len(chunks)
+    for (pos, ids, data), (decoded_pos, decoded_ids, decoded_data) in zip(chunks, decoded):
+        assert decoded_pos == pos
+        assert (decoded_ids == ids).all() and (decoded_data == data).all()
+
+
+def test_chunk_round_trip():
+    ids, data = make_chunk(7)
+    record = encode_chunk((3, 5), ids, data)
+    (pos, decoded_ids, decoded_data), offset = decode_chunk(record, 0, 32)
+    assert (pos, offset) == ((3, 5), len(record))
+    assert (decoded_ids == ids).all() and (decoded_data == data).all()
+
+
+def test_truncated_world():
+    data = encode_world(32, (1, 1), [((0, 0), *make_chunk(1))])
+    for end in (0, 5, len(data) - 1):
+        with pytest.raises(FormatError):
+            decode_world(data[:end])
+
+
+def test_bad_magic():
+    data = encode_world(32, (1, 1), [])
+    with pytest.raises(FormatError):
+        decode_world(b'XXX' + data[3:])
+
+
+def test_changes_round_trip():
+    chunks = [((1, 2), 7, [(0, 0, 1, 0), (31, 31, 255, 3)]), ((-1, 0), 9, [])]
+    assert decode_changes(encode_changes(chunks)) == chunks
+    with pytest.raises(FormatError):
+        decode_changes(encode_changes(chunks)[:-1])